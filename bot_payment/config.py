@@ -9,6 +9,8 @@ DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_USER = os.getenv("DB_USER", "admin")
 DB_PASS = os.getenv("DB_PASS", "admin123")
 DB_NAME = os.getenv("DB_NAME", "berserk_stats")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5")) # Connections kept open
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")) # Wait for the web app's writes instead of failing
 
 # Logging
 LOG_FILE = "payment_bot.log"
@@ -3,5 +3,9 @@ import os
 # Telegram Bot Settings
 BOT_TOKEN = "YOUR_BOT_TOKEN_HERE"
 
+# Database Settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5")) # Connections kept open
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")) # Wait for the web app's writes instead of failing
+
 # Logging
 LOG_FILE = os.getenv("LOG_FILE", "payment_bot.log")
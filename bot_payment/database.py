@@ -4,11 +4,12 @@ import os
 # Add parent directory to path for database import
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, Text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
 import config
+from web_v1.engines import make_engine, pool_stats
 
 Base = declarative_base()
 
@@ -30,6 +31,14 @@ class User(Base):
     gift_notification = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.now)
 
+class SyncState(Base):
+    """Shared with the web app (web_v1/database.py), used here to flag changed users."""
+    __tablename__ = 'sync_state'
+
+    key = Column(String(100), primary_key=True)
+    value = Column(String(500), nullable=True)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
 class Database:
     def __init__(self):
         # Use SQLite database (same as web app for local development)
@@ -37,11 +46,30 @@ class Database:
         db_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'berserk_local_v2.db'))
         
         connection_string = f"sqlite:///{db_path}"
-        self.engine = create_engine(connection_string, pool_pre_ping=True)
+        # Same pool / WAL profile as the web app, so payment writes don't block its page reads
+        self.engine = make_engine(
+            connection_string,
+            pool_size=getattr(config, "DB_POOL_SIZE", 5),
+            max_overflow=getattr(config, "DB_MAX_OVERFLOW", 5),
+            pool_pre_ping=True,
+            busy_timeout_ms=getattr(config, "SQLITE_BUSY_TIMEOUT_MS", 5000)
+        )
         self.SessionLocal = sessionmaker(bind=self.engine)
     
     def get_session(self):
         return self.SessionLocal()
+
+    def pool_stats(self):
+        return pool_stats(self.engine)
     
     def create_tables(self):
         Base.metadata.create_all(self.engine)
+
+    def touch_principal(self, session, telegram_id):
+        """Tells the web app to drop its cached copy of this user. Caller commits."""
+        key = f"principal:{telegram_id}"
+        state = session.get(SyncState, key)
+        if not state:
+            state = SyncState(key=key)
+            session.add(state)
+        state.updated_at = datetime.now()
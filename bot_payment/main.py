@@ -59,6 +59,7 @@ async def cmd_start(message: types.Message):
                 first_name=message.from_user.first_name
             )
             session.add(user)
+            db.touch_principal(session, message.from_user.id)
             session.commit()
             logger.info(f"Created new user: {message.from_user.id}")
     finally:
@@ -220,6 +221,7 @@ async def process_successful_payment(message: types.Message):
             user.premium_until = now + timedelta(days=actual_days)
             logger.info(f"New Premium until {user.premium_until}")
         
+        db.touch_principal(session, tg_id) # Web app shows Premium without waiting for its cache TTL
         session.commit()
         
         await message.answer(
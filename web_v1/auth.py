@@ -0,0 +1,101 @@
+import hashlib
+import hmac
+import time
+from collections import OrderedDict
+
+import config
+
+SESSION_COOKIE = "session"
+SESSION_MAX_AGE = getattr(config, "SESSION_MAX_AGE", 30 * 24 * 3600)
+
+# Falls back to a key derived from the bot token, so existing configs keep working
+_secret = getattr(config, "SESSION_SECRET", "") or hashlib.sha256(f"session:{config.BOT_TOKEN}".encode()).hexdigest()
+SESSION_KEY = _secret.encode()
+
+# --- SESSION TOKENS ---
+
+def _sign(payload: str) -> str:
+    return hmac.new(SESSION_KEY, payload.encode(), hashlib.sha256).hexdigest()
+
+def sign_session(telegram_id: int) -> str:
+    """Cookie value "<telegram_id>.<issued_at>.<hmac>"."""
+    payload = f"{telegram_id}.{int(time.time())}"
+    return f"{payload}.{_sign(payload)}"
+
+def verify_session(token: str, max_age: int = SESSION_MAX_AGE):
+    """telegram_id from a valid, unexpired token, else None."""
+    if not token: return None
+    try:
+        tg_id, issued, sig = token.split(".")
+        if not hmac.compare_digest(sig, _sign(f"{tg_id}.{issued}")): return None
+        if time.time() - int(issued) > max_age: return None
+        return int(tg_id)
+    except (ValueError, TypeError): # Malformed or non-ASCII cookie
+        return None
+
+# --- READ-YOUR-WRITES ---
+
+PRIMARY_COOKIE = "read_primary"
+
+def sign_primary_until(until: float) -> str:
+    """Cookie value "<unix time>.<hmac>": read from the primary DB until then."""
+    payload = f"primary.{int(until) + 1}"
+    return f"{int(until) + 1}.{_sign(payload)}"
+
+def verify_primary_until(token: str) -> float:
+    """Time from a valid token (0 if missing or forged)."""
+    if not token: return 0.0
+    try:
+        until, sig = token.split(".")
+        if not hmac.compare_digest(sig, _sign(f"primary.{until}")): return 0.0
+        return float(until)
+    except (ValueError, TypeError):
+        return 0.0
+
+# --- PRINCIPALS ---
+
+class Principal:
+    """Detached snapshot of a User with the fields routes and templates read."""
+
+    FIELDS = ("id", "telegram_id", "username", "first_name", "photo_url", "is_admin",
+              "is_premium", "premium_since", "premium_until", "is_banned", "ban_until", "gift_notification")
+    __slots__ = FIELDS
+
+    def __init__(self, user):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(user, field))
+
+class PrincipalCache:
+    """TTL + LRU cache of resolved users by telegram_id. Unknown ids are cached as None."""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict() # telegram_id -> (principal or None, expires_at)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, telegram_id):
+        """(True, principal) on a hit, (False, None) on a miss."""
+        entry = self.entries.get(telegram_id)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(telegram_id)
+        self.hits += 1
+        return True, entry[0]
+
+    def put(self, telegram_id, principal):
+        self.entries[telegram_id] = (principal, time.monotonic() + self.ttl)
+        self.entries.move_to_end(telegram_id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, telegram_id):
+        self.entries.pop(telegram_id, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,251 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+
+from fastapi import WebSocket
+
+from pubsub import CHAT_CHANNEL, PRESENCE_CHANNEL, InProcessPubSub
+
+logger = logging.getLogger(__name__)
+
+# --- PER-CLIENT CONNECTION ---
+
+class ClientConnection:
+    """One websocket with its own bounded outbound queue and writer task.
+
+    Broadcasts only enqueue pre-serialized text, so a slow client never delays the others.
+    """
+
+    def __init__(self, websocket: WebSocket, user_data: dict, manager, max_queue: int):
+        self.websocket = websocket
+        self.user_data = user_data
+        self.manager = manager
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.writer = None
+        self.closed = False
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def enqueue(self, text: str) -> bool:
+        """False if the client is too far behind (queue full)."""
+        try:
+            self.queue.put_nowait((text, time.perf_counter()))
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def _write_loop(self):
+        try:
+            while True:
+                text, queued_at = await self.queue.get()
+                await asyncio.wait_for(self.websocket.send_text(text), timeout=self.manager.send_timeout)
+                self.manager.latencies.append(time.perf_counter() - queued_at)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # Send failed or timed out: the socket is dead or hopelessly slow
+            logger.info(f"WS writer stopped: {e!r}")
+            self.manager.evict(self)
+
+    async def close(self, code: int = 1000):
+        if self.closed: return
+        self.closed = True
+        if self.writer and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+# --- MANAGER ---
+
+class ConnectionManager:
+    """Fan-out engine: serializes each message once and hands it to every client's queue.
+
+    Broadcasts go through the pub/sub backend, so with a shared backend (Redis) a message
+    sent on one worker reaches the clients of every worker.
+
+    Presence is sent as versioned join/leave deltas, coalesced over `presence_window` seconds.
+    A client gets one full snapshot on connect and applies the deltas on top of it.
+    """
+
+    def __init__(self, max_queue: int = 256, send_timeout: float = 10.0, backend=None, presence_window: float = 1.0):
+        # Map websocket to its connection (user data: {"id": 1, "username": "Admin", "photo_url": "..."})
+        self.active_connections: dict = {}
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.backend = backend or InProcessPubSub()
+        self.listeners = [] # Called with every chat message, from this worker or another one
+
+        # Presence
+        self.presence_window = presence_window
+        self.user_refs = {}   # user_id -> open connections on this worker (duplicate tabs)
+        self.users = {}       # user_id -> user data, users with at least one connection
+        self.pending = {}     # user_id -> user data (join) or None (leave), flushed once per window
+        self.flush_task = None
+        self.presence_version = 0
+        self._snapshot = None # (version, serialized snapshot)
+
+        # Metrics
+        self.latencies = deque(maxlen=2000) # Seconds from enqueue to send, recent deliveries
+        self.messages_broadcast = 0
+        self.clients_evicted = 0
+        self.presence_deltas = 0
+
+    async def start(self):
+        await self.backend.start(self._on_backend_message)
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+        await self.backend.close()
+
+    async def _on_backend_message(self, channel: str, text: str):
+        if channel == CHAT_CHANNEL:
+            self._deliver_local(text)
+            if self.listeners:
+                message = json.loads(text)
+                for listener in self.listeners:
+                    listener(message)
+        elif channel == PRESENCE_CHANNEL:
+            version = json.loads(text)["version"]
+            if version > self.presence_version:
+                self.presence_version = version
+            self._deliver_local(text)
+
+    async def connect(self, websocket: WebSocket, user_data: dict = None):
+        await websocket.accept()
+        conn = ClientConnection(websocket, user_data, self, self.max_queue)
+        self.active_connections[websocket] = conn
+        conn.start()
+        if user_data:
+            self._user_joined(user_data)
+        if not conn.enqueue(await self.presence_snapshot()):
+            self.evict(conn)
+
+    async def disconnect(self, websocket: WebSocket):
+        conn = self.active_connections.pop(websocket, None)
+        if conn:
+            await conn.close()
+            if conn.user_data:
+                self._user_left(conn.user_data)
+
+    def evict(self, conn: ClientConnection):
+        """Drops a client that fell too far behind. Its receive loop then ends with a disconnect."""
+        if self.active_connections.get(conn.websocket) is not conn: return
+        del self.active_connections[conn.websocket]
+        self.clients_evicted += 1
+        # 1013 = Try Again Later: the page reconnects and reloads history
+        asyncio.create_task(conn.close(code=1013))
+        if conn.user_data:
+            self._user_left(conn.user_data)
+
+    async def send_personal(self, websocket: WebSocket, message: dict):
+        conn = self.active_connections.get(websocket)
+        if conn and not conn.enqueue(json.dumps(message)):
+            self.evict(conn)
+
+    async def broadcast(self, message: dict):
+        text = json.dumps(message) # Serialize once for all clients
+        self.messages_broadcast += 1
+        await self.backend.publish(CHAT_CHANNEL, text)
+
+    def _deliver_local(self, text: str):
+        for conn in list(self.active_connections.values()):
+            if not conn.enqueue(text):
+                self.evict(conn)
+
+    # --- PRESENCE ---
+
+    def _user_joined(self, data: dict):
+        uid = data.get("id")
+        if not uid: return
+        self.user_refs[uid] = self.user_refs.get(uid, 0) + 1
+        if self.user_refs[uid] == 1:
+            self.users[uid] = data
+            self._queue_delta(uid, data)
+
+    def _user_left(self, data: dict):
+        uid = data.get("id")
+        if uid not in self.user_refs: return
+        self.user_refs[uid] -= 1
+        if self.user_refs[uid] == 0:
+            del self.user_refs[uid]
+            del self.users[uid]
+            self._queue_delta(uid, None)
+
+    def _queue_delta(self, uid, data):
+        # A leave and a join inside one window cancel out (page reload, reconnect storm)
+        if uid in self.pending and (self.pending[uid] is None) != (data is None):
+            del self.pending[uid]
+        else:
+            self.pending[uid] = data
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_presence())
+
+    async def _flush_presence(self):
+        await asyncio.sleep(self.presence_window)
+        self.flush_task = None
+        pending, self.pending = self.pending, {}
+        try:
+            await self.backend.set_presence(self.users)
+            joined = [data for data in pending.values() if data]
+            left = [uid for uid, data in pending.items() if data is None]
+            if left:
+                # Still online through another worker
+                online = await self.backend.get_presence()
+                left = [uid for uid in left if uid not in online]
+            if not joined and not left: return
+
+            version = await self.backend.next_presence_version()
+            self.presence_deltas += 1
+            await self.backend.publish(PRESENCE_CHANNEL, json.dumps({
+                "type": "presence",
+                "version": version,
+                "joined": joined,
+                "left": left
+            }))
+        except Exception as e:
+            logger.error(f"Presence flush failed: {e}")
+
+    async def presence_snapshot(self) -> str:
+        """Serialized online list with its version, rebuilt only after a delta."""
+        if self._snapshot and self._snapshot[0] == self.presence_version:
+            return self._snapshot[1]
+        known = self.presence_version
+        # Version first: the users read after it can only be newer, and deltas are idempotent
+        version = await self.backend.presence_version()
+        users = await self.backend.get_presence()
+        text = json.dumps({
+            "type": "presence_snapshot",
+            "version": version,
+            "users": list(users.values())
+        })
+        self._snapshot = (known, text)
+        return text
+
+    def stats(self) -> dict:
+        """Queue depth and delivery latency metrics."""
+        depths = [conn.queue.qsize() for conn in self.active_connections.values()]
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies: return 0.0
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2)
+
+        return {
+            "connections": len(depths),
+            "queued_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "queue_limit": self.max_queue,
+            "messages_broadcast": self.messages_broadcast,
+            "clients_evicted": self.clients_evicted,
+            "online_users": len(self.users),
+            "presence_version": self.presence_version,
+            "presence_deltas": self.presence_deltas,
+            "delivery_ms_p50": percentile(0.5),
+            "delivery_ms_p99": percentile(0.99),
+        }
@@ -0,0 +1,62 @@
+from bisect import bisect_left, insort
+
+class TeamCatalog:
+    """In-memory teams per league (game_type) with prefix search.
+
+    Mirrors the team_catalog table: loaded once, then extended with the teams of newly
+    synced matches. A search key is kept for the full name and for every word in it,
+    so "spi" finds "Team Spirit".
+    """
+
+    def __init__(self):
+        self.by_league = {} # game_type -> sorted team names
+        self.keys = {}      # game_type -> sorted (search key, team name)
+
+    def load(self, pairs):
+        """Replaces the catalog with (game_type, team) pairs."""
+        self.by_league = {}
+        self.keys = {}
+        self.add(pairs)
+
+    def add(self, pairs):
+        for game_type, team in pairs:
+            if not team: continue
+            teams = self.by_league.setdefault(game_type, [])
+            i = bisect_left(teams, team)
+            if i < len(teams) and teams[i] == team: continue
+            teams.insert(i, team)
+            keys = self.keys.setdefault(game_type, [])
+            for key in self._search_keys(team):
+                insort(keys, (key, team))
+
+    @staticmethod
+    def _search_keys(team):
+        words = team.casefold().split()
+        return {" ".join(words[i:]) for i in range(len(words))} or {team.casefold()}
+
+    def leagues(self):
+        return sorted(self.by_league)
+
+    def teams(self, league=None, prefix=None, limit=None):
+        """Sorted team names of one league (None = all), optionally starting with `prefix` (any word)."""
+        leagues = [league] if league else list(self.by_league)
+        if not prefix:
+            if league:
+                names = self.by_league.get(league, [])
+            else:
+                names = sorted({t for lg in leagues for t in self.by_league[lg]})
+            return names[:limit] if limit else list(names)
+
+        prefix = prefix.casefold().strip()
+        found = set()
+        for lg in leagues:
+            keys = self.keys.get(lg, [])
+            i = bisect_left(keys, (prefix,))
+            while i < len(keys) and keys[i][0].startswith(prefix):
+                found.add(keys[i][1])
+                i += 1
+        names = sorted(found)
+        return names[:limit] if limit else names
+
+    def stats(self) -> dict:
+        return {league: len(teams) for league, teams in self.by_league.items()}
@@ -0,0 +1,64 @@
+import hashlib
+import json
+from collections import deque
+
+def message_payload(m) -> dict:
+    """History entry for a ChatMessage with its user loaded."""
+    return {
+        "id": m.id,
+        "content": m.content,
+        "username": m.user.username or m.user.first_name,
+        "is_admin": m.user.is_admin,
+        "is_premium": m.user.is_premium,
+        "photo_url": m.user.photo_url,
+        "created_at": m.created_at.strftime("%H:%M"),
+        "timestamp": m.created_at.timestamp(),
+        "reply_to": m.reply_to_id,
+        "is_edited": m.is_edited
+    }
+
+class ChatHistory:
+    """Ring buffer of the newest chat messages, rendered once per change.
+
+    Warmed from the DB at startup and kept current from the chat stream
+    (new_message / delete / message_ids), so /api/chat/history never touches the DB.
+    """
+
+    def __init__(self, size: int = 100):
+        self.messages = deque(maxlen=size)
+        self._rendered = None # (body bytes, etag)
+
+    def load(self, payloads):
+        self.messages.clear()
+        self.messages.extend(payloads)
+        self._rendered = None
+
+    def apply(self, message: dict):
+        """Updates the buffer from a broadcast chat message."""
+        kind = message.get("type")
+        if kind == "new_message":
+            entry = dict(message)
+            del entry["type"]
+            self.messages.append(entry)
+        elif kind == "delete":
+            kept = [m for m in self.messages if m["id"] != message["id"]]
+            if len(kept) == len(self.messages): return
+            self.messages.clear()
+            self.messages.extend(kept)
+        elif kind == "message_ids":
+            ids = {int(k): v for k, v in message["ids"].items()}
+            for m in self.messages:
+                if m["id"] in ids: m["id"] = ids[m["id"]]
+                if m["reply_to"] in ids: m["reply_to"] = ids[m["reply_to"]]
+        else:
+            return
+        self._rendered = None
+
+    def render(self):
+        """(JSON bytes, ETag) of the buffer, oldest message first."""
+        if self._rendered is None:
+            body = json.dumps(list(self.messages)).encode()
+            # Content hash, so every worker hands out the same ETag for the same history
+            etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+            self._rendered = (body, etag)
+        return self._rendered
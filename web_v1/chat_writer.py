@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class ChatWriter:
+    """Write-behind buffer for chat messages.
+
+    A message is broadcast right away with a provisional (negative) id and queued here.
+    Queued messages are group-committed every `flush_interval` seconds or `batch_size`
+    messages. Then `on_commit({provisional_id: id})` is called so clients can swap ids.
+    A message the DB refuses is retried on its own; after MAX_ATTEMPTS it is dropped and
+    `on_drop([provisional_id])` is called so clients can take it back.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, db, on_commit=None, on_drop=None, flush_interval: float = 0.02, batch_size: int = 50):
+        self.db = db
+        self.on_commit = on_commit
+        self.on_drop = on_drop
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = []               # Messages waiting for the next group commit, oldest first
+        self.resolved = OrderedDict()   # provisional_id -> id, recent messages only
+        self.lock = asyncio.Lock()      # Held while a batch is in the DB
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self._last_id = 0
+
+        # Metrics
+        self.batches = 0
+        self.messages_written = 0
+        self.messages_dropped = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stops the flush loop and writes what is still queued."""
+        if self.task:
+            self.task.cancel()
+        await self.flush()
+
+    def provisional_id(self) -> int:
+        # Negative microsecond timestamp: never clashes with DB ids, unique enough across workers
+        n = max(time.time_ns() // 1000, self._last_id + 1)
+        self._last_id = n
+        return -n
+
+    def add(self, message: dict):
+        """Queues {"provisional_id", "user_id", "content", "reply_to_id", "created_at"}."""
+        message["attempts"] = 0
+        self.pending.append(message)
+        self.wakeup.set()
+
+    async def resolve(self, msg_id):
+        """DB id for a message id from a client, which may be provisional."""
+        if not isinstance(msg_id, int) or msg_id >= 0:
+            return msg_id
+        async with self.lock: # Waits out a batch that is being written right now
+            return self.resolved.get(msg_id)
+
+    async def discard(self, msg_id):
+        """Drops a queued message before it reaches the DB. Otherwise returns its DB id to delete."""
+        for i, m in enumerate(self.pending):
+            if m["provisional_id"] == msg_id:
+                del self.pending[i]
+                return None
+        return await self.resolve(msg_id)
+
+    async def _run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            # Group commit: give concurrent senders a moment to join the batch
+            if len(self.pending) < self.batch_size:
+                await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        while self.pending:
+            async with self.lock:
+                batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+                in_batch = {m["provisional_id"] for m in batch}
+                for m in batch:
+                    reply_to = m["reply_to_id"]
+                    if isinstance(reply_to, int) and reply_to < 0 and reply_to not in in_batch:
+                        m["reply_to_id"] = self.resolved.get(reply_to) # None if it never got written
+                try:
+                    ids = await self.db.run_sync(self.db.insert_chat_messages, batch)
+                except Exception as e:
+                    logger.error(f"Chat flush failed ({len(batch)} messages): {e}")
+                    ids = {}
+                if ids:
+                    self.batches += 1
+                    self.messages_written += len(ids)
+                    self.resolved.update(ids)
+                    while len(self.resolved) > 1000:
+                        self.resolved.popitem(last=False)
+
+                # Messages the DB refused (the whole batch if it failed) go back to the queue
+                failed = [m for m in batch if m["provisional_id"] not in ids]
+                retry = [m for m in failed if m["attempts"] < self.MAX_ATTEMPTS - 1]
+                dropped = [m["provisional_id"] for m in failed if m["attempts"] >= self.MAX_ATTEMPTS - 1]
+                for m in retry:
+                    m["attempts"] += 1
+                self.messages_dropped += len(dropped)
+                self.pending = retry + self.pending
+
+            for callback, arg in ((self.on_commit, ids), (self.on_drop, dropped)):
+                if callback and arg:
+                    try:
+                        await callback(arg)
+                    except Exception as e:
+                        logger.error(f"Chat callback failed: {e}")
+            if not ids:
+                await asyncio.sleep(1) # Back off (outside the lock: resolve() must not wait for it)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "batches": self.batches,
+            "messages_written": self.messages_written,
+            "messages_dropped": self.messages_dropped,
+            "messages_per_batch": round(self.messages_written / self.batches, 2) if self.batches else 0.0,
+        }
@@ -13,3 +13,64 @@ DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_USER = os.getenv("DB_USER", "admin")
 DB_PASS = os.getenv("DB_PASS", "admin123")
 DB_NAME = os.getenv("DB_NAME", "berserk_stats")
+DB_THREAD_POOL_SIZE = int(os.getenv("DB_THREAD_POOL_SIZE", "8")) # Threads for blocking DB work from async routes
+SOURCE_POOL_SIZE = int(os.getenv("SOURCE_POOL_SIZE", "4")) # Threads per bot DB (match source): a hanging source only ties up its own
+SOURCE_TIMEOUT = float(os.getenv("SOURCE_TIMEOUT", "5")) # Seconds to wait for a source before serving without it
+SOURCE_QUERY_TIMEOUT = int(os.getenv("SOURCE_QUERY_TIMEOUT", "30")) # Seconds before the driver aborts a stuck query to a MySQL bot DB
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10")) # Connections kept open per engine
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10")) # Extra connections under load
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600")) # Seconds before a connection is replaced
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30")) # Seconds to wait for a free connection
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")) # SQLite: wait for a lock instead of failing
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))) # SQLite: bytes of the DB file read through mmap
+DB_REPLICA_URLS = [u for u in os.getenv("DB_REPLICA_URLS", "").split(",") if u] # Read replicas of the main DB (SQLAlchemy URLs)
+DB_STICKY_SECONDS = float(os.getenv("DB_STICKY_SECONDS", "5")) # A user reads from the primary this long after writing (>= replica lag)
+
+# Match Sources (bot DBs). Add an entry to aggregate another game.
+# dsn: SQLAlchemy URL; if empty, sqlite_file (project root) is used while the main DB is SQLite,
+# otherwise the main DB itself (matches told apart by game_type). Optional pool settings:
+# pool_size, max_overflow, pool_recycle, pool_timeout.
+MATCH_SOURCES = [
+    {"game_type": "CS2", "league_name": "1x1 CS2 Berserk League", "dsn": os.getenv("CS2_DB_URL", ""), "sqlite_file": "berserk_cs2_v2.db"},
+    {"game_type": "DOTA2", "league_name": "1x1 Dota2 Berserk League", "dsn": os.getenv("DOTA_DB_URL", ""), "sqlite_file": "berserk_dota_v2.db"},
+]
+
+# Background Jobs
+MATCH_SYNC_INTERVAL = int(os.getenv("MATCH_SYNC_INTERVAL", "30")) # Seconds between bot DB syncs
+SYNC_OVERLAP_SECONDS = int(os.getenv("SYNC_OVERLAP_SECONDS", "10")) # Bot rows re-read behind the sync watermark (same-second and late commits)
+
+# Chat
+CHAT_QUEUE_SIZE = int(os.getenv("CHAT_QUEUE_SIZE", "256")) # Max queued messages per client before it is dropped
+CHAT_SEND_TIMEOUT = float(os.getenv("CHAT_SEND_TIMEOUT", "10")) # Seconds a single websocket send may take
+CHAT_PRESENCE_WINDOW = float(os.getenv("CHAT_PRESENCE_WINDOW", "1.0")) # Seconds to coalesce online join/leave updates
+CHAT_FLUSH_INTERVAL_MS = int(os.getenv("CHAT_FLUSH_INTERVAL_MS", "20")) # Group commit window for new messages
+CHAT_FLUSH_BATCH = int(os.getenv("CHAT_FLUSH_BATCH", "50")) # Max messages per group commit
+CHAT_HISTORY_SIZE = int(os.getenv("CHAT_HISTORY_SIZE", "100")) # Messages kept in the DB and served by /api/chat/history
+CHAT_RETENTION_INTERVAL = int(os.getenv("CHAT_RETENTION_INTERVAL", "60")) # Seconds between retention runs
+CHAT_PUBSUB_URL = os.getenv("CHAT_PUBSUB_URL", "") # e.g. redis://localhost:6379/0, required when WEB_WORKERS > 1
+
+# Web Server
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1")) # uvicorn worker processes
+
+# Auth
+SESSION_SECRET = os.getenv("SESSION_SECRET", "") # HMAC key for session cookies (empty = derived from BOT_TOKEN)
+SESSION_MAX_AGE = int(os.getenv("SESSION_MAX_AGE", str(30 * 24 * 3600))) # Seconds a login stays valid
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000")) # Cached users
+PRINCIPAL_CACHE_TTL = int(os.getenv("PRINCIPAL_CACHE_TTL", "60")) # Seconds before a cached user is reloaded
+PRINCIPAL_POLL_INTERVAL = int(os.getenv("PRINCIPAL_POLL_INTERVAL", "2")) # Seconds between checks for users changed elsewhere
+
+# Page Cache
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", "256")) # Rendered page fragments kept per worker
+
+# Analytics
+TEAM_LIST_LIMIT = int(os.getenv("TEAM_LIST_LIMIT", "200")) # Teams per /api/teams response and analytics dropdown
+PREDICT_BATCH_LIMIT = int(os.getenv("PREDICT_BATCH_LIMIT", "500")) # Max team pairs per /api/predict/batch request
+RATING_WEIGHT = float(os.getenv("RATING_WEIGHT", "0.3")) # Share of the team rating in /api/predict
+
+# Ratings (run rebuild_ratings.py after changing them)
+RATING_SYSTEM = os.getenv("RATING_SYSTEM", "elo") # "elo" or "glicko"
+RATING_INITIAL = float(os.getenv("RATING_INITIAL", "1500")) # Rating of a new team
+RATING_K = float(os.getenv("RATING_K", "32")) # Elo K-factor
+RATING_INITIAL_RD = float(os.getenv("RATING_INITIAL_RD", "350")) # Glicko: deviation of a new team (also the max)
+RATING_MIN_RD = float(os.getenv("RATING_MIN_RD", "30")) # Glicko: deviation floor
+RATING_RD_GROWTH = float(os.getenv("RATING_RD_GROWTH", "35")) # Glicko: deviation growth per idle day
@@ -1,10 +1,28 @@
-from sqlalchemy import create_engine, Column, String, Integer, Float, DateTime, Enum, JSON, Boolean, BigInteger, ForeignKey
+from sqlalchemy import event, bindparam, column, func, inspect, or_, select, table, Column, String, Integer, Float, DateTime, Enum, JSON, Boolean, BigInteger, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import Session, sessionmaker, relationship
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextvars import ContextVar, copy_context
+from datetime import datetime, timedelta
+from functools import partial
+from itertools import count, islice
+import asyncio
+import base64
+import heapq
+import json
+import logging
+import os
+import re
+import threading
+import time
 import config
+from engines import make_async_engine, make_engine, pool_stats
+from ratings import RatingEngine
 
 Base = declarative_base()
+logger = logging.getLogger(__name__)
 
 # --- MODELS ---
 
@@ -27,6 +45,15 @@ class User(Base):
     created_at = Column(DateTime, default=datetime.now)
     gift_notification = Column(String(500), nullable=True)
 
+    __table_args__ = (
+        # Admin user list: keyset order (created_at DESC, id DESC), per filter, and username search
+        Index('ix_users_created', 'created_at', 'id'),
+        Index('ix_users_premium_created', 'is_premium', 'created_at', 'id'),
+        Index('ix_users_banned_created', 'is_banned', 'created_at', 'id'),
+        Index('ix_users_admin_created', 'is_admin', 'created_at', 'id'),
+        Index('ix_users_username_lower', func.lower(username)),
+    )
+
 class ChatMessage(Base):
     __tablename__ = 'chat_messages'
     
@@ -49,6 +76,7 @@ class Match(Base):
     team1 = Column(String(100))
     team2 = Column(String(100))
     match_time = Column(String(50)) 
+    match_ts = Column(DateTime, nullable=True) # Parsed match_time, NULL for 'UNKNOWN'
     status = Column(Enum('UPCOMING', 'LIVE', 'FINISHED', name='match_status'))
     score = Column(String(50), default="0:0")
     map_scores = Column(JSON, nullable=True)
@@ -58,6 +86,69 @@ class Match(Base):
     message_id = Column(Integer, nullable=True)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
+    __table_args__ = (
+        Index('ix_matches_status_ts', 'status', 'match_ts'),
+        Index('ix_matches_game_status_ts', 'game_type', 'status', 'match_ts'),
+        Index('ix_matches_status_updated', 'status', 'updated_at'), # Sync watermarks and /api/matches/export
+    )
+
+# --- MATCH TIME NORMALIZATION ---
+
+MATCH_TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M')
+
+def parse_match_time(value):
+    """Parses the legacy match_time string. Returns None for 'UNKNOWN' and garbage."""
+    if isinstance(value, datetime): return value
+    if not value: return None
+    for fmt in MATCH_TIME_FORMATS:
+        try: return datetime.strptime(str(value).strip(), fmt)
+        except ValueError: continue
+    return None
+
+@event.listens_for(Match, 'before_insert')
+@event.listens_for(Match, 'before_update')
+def _sync_match_ts(mapper, connection, target):
+    target.match_ts = parse_match_time(target.match_time)
+
+def backfill_match_ts(engine, batch_size=500, pause=0.05):
+    """Fills match_ts for rows written without it (legacy rows, bots using their own model).
+
+    Works in short id-ordered batches with a commit per batch so bot writers are never
+    blocked for long. Safe to re-run: only rows with NULL match_ts are touched, and
+    'UNKNOWN' times (which stay NULL) are skipped, so a run with nothing to do is one query.
+    """
+    table = Match.__table__
+    select_batch = (
+        table.select().with_only_columns(table.c.id, table.c.match_time)
+        .where(
+            table.c.match_ts.is_(None), table.c.match_time.isnot(None), table.c.match_time != 'UNKNOWN',
+            table.c.id > bindparam('last_id')
+        )
+        .order_by(table.c.id)
+        .limit(batch_size)
+    )
+    # updated_at is pinned: its onupdate default would stamp every row with now, wiping the
+    # bots' timestamps and the (updated_at, id) watermarks that syncs and exports follow
+    update_row = (
+        table.update().where(table.c.id == bindparam('b_id'))
+        .values(match_ts=bindparam('b_ts'), updated_at=table.c.updated_at)
+    )
+
+    last_id = ''
+    updated = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select_batch, {'last_id': last_id}).fetchall()
+            if not rows: break
+            last_id = rows[-1][0]
+            params = [{'b_id': r[0], 'b_ts': parse_match_time(r[1])} for r in rows]
+            params = [p for p in params if p['b_ts'] is not None]
+            if params:
+                conn.execute(update_row, params)
+                updated += len(params)
+        time.sleep(pause)
+    return updated
+
 class Discipline(Base):
     __tablename__ = 'disciplines'
     
@@ -81,126 +172,1369 @@ class StreamChannel(Base):
     
     discipline = relationship("Discipline", back_populates="channels")
 
+# --- DERIVED TABLES (Main DB, built from the bot DBs) ---
+
+class TeamMatch(Base):
+    """Per-team index of FINISHED matches from all bot DBs. Filled by Database.sync_team_matches."""
+    __tablename__ = 'team_matches'
+
+    team = Column(String(100), primary_key=True)
+    game_type = Column(String(50), primary_key=True) # Source DB, match ids are only unique per source
+    match_id = Column(String(255), primary_key=True)
+    opponent = Column(String(100))
+    match_ts = Column(DateTime, nullable=True)
+    is_home = Column(Boolean, default=True) # Team was team1
+    won = Column(Boolean, nullable=True) # None if score is a draw or unparsable
+    map1_won = Column(Boolean, nullable=True) # None if map 1 score is unknown
+    first_blood = Column(Boolean, default=False)
+
+    __table_args__ = (
+        Index('ix_team_matches_team_ts', team, match_ts.desc()),
+    )
+
+    def counts(self):
+        """(games, wins, losses, map1_wins, first_bloods) contributed by this row."""
+        return (1, int(self.won is True), int(self.won is False), int(bool(self.map1_won)), int(bool(self.first_blood)))
+
+TEAM_STATS_WINDOW = 20 # Games in the rolling "recent" window
+
+class TeamStats(Base):
+    """Per-team aggregates over team_matches, updated in the same transaction as the index."""
+    __tablename__ = 'team_stats'
+
+    team = Column(String(100), primary_key=True)
+    # All-time
+    games = Column(Integer, default=0)
+    wins = Column(Integer, default=0)
+    losses = Column(Integer, default=0)
+    map1_wins = Column(Integer, default=0)
+    first_bloods = Column(Integer, default=0)
+    # Last TEAM_STATS_WINDOW games
+    recent_games = Column(Integer, default=0)
+    recent_wins = Column(Integer, default=0)
+    recent_losses = Column(Integer, default=0)
+    recent_map1_wins = Column(Integer, default=0)
+    recent_first_bloods = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    ALL_TIME = ('games', 'wins', 'losses', 'map1_wins', 'first_bloods')
+    RECENT = ('recent_games', 'recent_wins', 'recent_losses', 'recent_map1_wins', 'recent_first_bloods')
+
+    def add(self, counts, sign=1):
+        for field, value in zip(self.ALL_TIME, counts):
+            setattr(self, field, (getattr(self, field) or 0) + sign * value)
+
+    def recent_rates(self):
+        """(winrate, fb_rate, map1_rate) over the recent window, 0.5 each if the team has no games."""
+        if not self.recent_games: return 0.5, 0.5, 0.5
+        n = self.recent_games
+        return self.recent_wins / n, self.recent_first_bloods / n, self.recent_map1_wins / n
+
+class CatalogTeam(Base):
+    """Distinct teams per league (game_type) across all match sources, filled by sync_team_matches."""
+    __tablename__ = 'team_catalog'
+
+    game_type = Column(String(50), primary_key=True)
+    team = Column(String(100), primary_key=True)
+
+class MatchMap(Base):
+    """Per-map scores of FINISHED matches, parsed once from the legacy map_scores / history formats."""
+    __tablename__ = 'match_maps'
+
+    game_type = Column(String(50), primary_key=True) # Source DB, like TeamMatch
+    match_id = Column(String(255), primary_key=True)
+    map_no = Column(Integer, primary_key=True)
+    s1 = Column(Integer, nullable=False)
+    s2 = Column(Integer, nullable=False)
+    winner_side = Column(Integer, nullable=True) # 1 or 2, None for a draw
+
+class TeamRating(Base):
+    """Rating of a team in one league (game_type), see ratings.RatingEngine. Filled by Database.sync_ratings."""
+    __tablename__ = 'team_ratings'
+
+    team = Column(String(100), primary_key=True)
+    game_type = Column(String(50), primary_key=True)
+    rating = Column(Float, nullable=False)
+    rd = Column(Float, default=0.0) # Rating deviation (Glicko), 0 for Elo
+    games = Column(Integer, default=0)
+    last_ts = Column(DateTime, nullable=True) # Time of the last rated match
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+class MatchPrediction(Base):
+    """Stored /api/predict result for every UPCOMING match of the bot DBs. Filled by Database.sync_predictions."""
+    __tablename__ = 'match_predictions'
+
+    game_type = Column(String(50), primary_key=True)
+    match_id = Column(String(255), primary_key=True)
+    team1 = Column(String(100))
+    team2 = Column(String(100))
+    match_ts = Column(DateTime, nullable=True)
+    winner = Column(String(100))
+    confidence = Column(Integer)
+    first_blood_rate = Column(Integer)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    __table_args__ = (
+        Index('ix_match_predictions_teams', team1, team2),
+        Index('ix_match_predictions_game_ts', game_type, match_ts),
+    )
+
+    def payload(self):
+        """Same shape as /api/predict, plus the match it was stored for."""
+        return {
+            "winner": self.winner,
+            "confidence": self.confidence,
+            "team1": self.team1,
+            "team2": self.team2,
+            "stats": {
+                "avg_duration": "~35-45m",
+                "first_blood_rate": self.first_blood_rate,
+                "win_probability": self.confidence
+            },
+            "game_type": self.game_type,
+            "match_id": self.match_id,
+            "match_ts": self.match_ts.isoformat() if self.match_ts else None
+        }
+
+class SyncState(Base):
+    """Watermarks, leases and change markers shared by the web workers and the bots."""
+    __tablename__ = 'sync_state'
+
+    key = Column(String(100), primary_key=True)
+    value = Column(String(500), nullable=True)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+def winner_side(score):
+    """1 or 2 for the side that won a 'S1:S2' score, None for draws and garbage."""
+    parsed = parse_score(score)
+    if not parsed or parsed[0] == parsed[1]: return None
+    return 1 if parsed[0] > parsed[1] else 2
+
+MAP_SCORE_RE = re.compile(r'^\s*(\d+)\s*[:-]\s*(\d+)\s*$')
+
+def parse_map_score(value):
+    """'13:11', '13-11' or [13, 11] -> (13, 11). None if unparsable."""
+    if isinstance(value, (list, tuple)):
+        if len(value) != 2: return None
+        try: return int(value[0]), int(value[1])
+        except (TypeError, ValueError): return None
+    match = MAP_SCORE_RE.match(str(value)) if value is not None else None
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+def parse_map_scores(map_scores, history=None):
+    """[(map_no, s1, s2)] of a match from any of the legacy formats, by map number.
+
+    Bots with a `history` column keep {"map_1": "16:5", ...} there, which wins. Otherwise
+    map_scores is a dict {"map1": "13-11", ...} (or the JSON text of one), a list,
+    a comma separated "16:5, 13:11" string or a single "16:5" (= map 1).
+    """
+    def from_items(items):
+        maps = []
+        for key, value in items:
+            digits = ''.join(ch for ch in str(key) if ch.isdigit())
+            score = parse_map_score(value)
+            if digits and score: maps.append((int(digits), *score))
+        return sorted(maps)
+
+    if isinstance(history, dict):
+        maps = from_items((k, v) for k, v in history.items() if str(k).startswith('map'))
+        if maps: return maps
+
+    value = map_scores
+    if isinstance(value, str) and value.strip()[:1] in ('{', '['):
+        try: value = json.loads(value)
+        except ValueError: pass
+    if isinstance(value, str):
+        value = re.split(r'[,;]', value)
+    if isinstance(value, dict):
+        return from_items(value.items())
+    if isinstance(value, list):
+        return from_items(enumerate(value, 1))
+    return []
+
+def match_map_rows(m, game_type):
+    """MatchMap rows of a FINISHED match."""
+    return [
+        MatchMap(game_type=game_type, match_id=m.id, map_no=map_no, s1=s1, s2=s2,
+                 winner_side=None if s1 == s2 else (1 if s1 > s2 else 2))
+        for map_no, s1, s2 in parse_map_scores(m.map_scores, getattr(m, 'history', None))
+    ]
+
+def team_match_rows(m, game_type, maps=None):
+    """Both TeamMatch index rows (one per side) for a FINISHED match. `maps` = its MatchMap rows."""
+    match_winner = winner_side(m.score)
+    if maps is None: maps = match_map_rows(m, game_type)
+    map1_winner = next((mp.winner_side for mp in maps if mp.map_no == 1), None)
+    first_blood = getattr(m, 'first_blood', None)
+
+    rows = []
+    for side, team, opponent in ((1, m.team1, m.team2), (2, m.team2, m.team1)):
+        if not team: continue
+        rows.append(TeamMatch(
+            team=team,
+            game_type=game_type,
+            match_id=m.id,
+            opponent=opponent,
+            match_ts=m.match_ts or parse_match_time(m.match_time),
+            is_home=(side == 1),
+            won=None if match_winner is None else (match_winner == side),
+            map1_won=None if map1_winner is None else (map1_winner == side),
+            first_blood=bool(first_blood) and first_blood == team
+        ))
+    return rows
+
+def parse_score(score):
+    """'2:1' -> (2, 1). None if the score is missing or malformed."""
+    if not score or ':' not in str(score): return None
+    try:
+        s1, s2 = str(score).split(':')[:2]
+        return int(s1), int(s2)
+    except ValueError:
+        return None
+
+def rating_order(match_ts, match_id):
+    """Order ratings are computed in: ORDER BY match_ts ASC, match_id ASC (NULL timestamps first)."""
+    return (match_ts is not None, match_ts or datetime.min, match_id)
+
+# --- FEED ROWS ---
+
+FEED_COLUMNS = ('id', 'game_type', 'match_time', 'match_ts', 'team1', 'team2', 'score', 'odds_p1', 'odds_p2')
+
+# Plain tuple per feed match: the selected columns, then fields derived for the page
+FeedMatch = namedtuple('FeedMatch', FEED_COLUMNS + ('source', 'league_name', 's1', 's2', 'maps', 'cursor'))
+
+# --- MATCH SOURCES ---
+
+# Used when config has no MATCH_SOURCES. `sqlite_file` (in the project root) is the
+# source's DB while the main DB is SQLite; without it and without a dsn the source reads
+# the main DB.
+DEFAULT_MATCH_SOURCES = [
+    {"game_type": "CS2", "league_name": "1x1 CS2 Berserk League", "sqlite_file": "berserk_cs2_v2.db"},
+    {"game_type": "DOTA2", "league_name": "1x1 Dota2 Berserk League", "sqlite_file": "berserk_dota_v2.db"},
+]
+SOURCE_POOL_OPTIONS = ("pool_size", "max_overflow", "pool_recycle", "pool_timeout")
+
+# Columns only some bots have: `history` ({"map_1": "16:5", ...}, JSON) and `first_blood`
+# (name of the team that drew it). Not on the Match model, see MatchSource.attach_optional.
+OPTIONAL_MATCH_COLUMNS = ("history", "first_blood")
+
+def engine_options():
+    """Pool and SQLite settings from config, passed to engines.make_engine / make_async_engine."""
+    return {
+        "pool_size": getattr(config, "DB_POOL_SIZE", 10),
+        "max_overflow": getattr(config, "DB_MAX_OVERFLOW", 10),
+        "pool_recycle": getattr(config, "DB_POOL_RECYCLE", 3600),
+        "pool_timeout": getattr(config, "DB_POOL_TIMEOUT", 30),
+        "busy_timeout_ms": getattr(config, "SQLITE_BUSY_TIMEOUT_MS", 5000),
+        "mmap_size": getattr(config, "SQLITE_MMAP_SIZE", 256 * 1024 * 1024),
+    }
+
+class MatchSource:
+    """One bot DB of the source registry.
+
+    game_type is also the key of its rows in the derived tables, league_name the branding
+    of its matches. The engine is only created by the first get_session(). A `shared`
+    source lives in a DB that also holds other game types (e.g. the main DB on MySQL):
+    `query()` then filters by game_type, so no match is read by two sources.
+    """
+
+    def __init__(self, game_type, league_name, connect, shared=False, dsn=None):
+        self.game_type = game_type
+        self.league_name = league_name
+        self.shared = shared
+        self.dsn = dsn
+        self._connect = connect # () -> sessionmaker
+        self._optional = None # OPTIONAL_MATCH_COLUMNS of this source's matches table, looked up once
+
+    def __repr__(self):
+        return f"MatchSource({self.game_type!r})"
+
+    def optional_columns(self, session):
+        if self._optional is None:
+            names = {c["name"] for c in inspect(session.get_bind()).get_columns("matches")}
+            self._optional = tuple(name for name in OPTIONAL_MATCH_COLUMNS if name in names)
+        return self._optional
+
+    def attach_optional(self, session, matches):
+        """Sets `history` and `first_blood` on Match rows of this source (None where it has no such column)."""
+        names = self.optional_columns(session)
+        found = {}
+        if names and matches:
+            matches_table = table("matches", column("id"), *(column(name) for name in names))
+            for row in session.execute(
+                select(matches_table).where(matches_table.c.id.in_([m.id for m in matches]))
+            ).mappings():
+                found[row["id"]] = row
+        for m in matches:
+            row = found.get(m.id, {})
+            history = row.get("history")
+            if isinstance(history, (str, bytes)):
+                try: history = json.loads(history)
+                except ValueError: history = None
+            m.history = history
+            m.first_blood = row.get("first_blood")
+
+    def get_session(self):
+        return self._connect()()
+
+    def query(self, session, *entities):
+        """session.query(*entities) limited to this source's matches."""
+        q = session.query(*entities)
+        return q.filter(Match.game_type == self.game_type) if self.shared else q
+
+class SourceResults(list):
+    """Results merged from several sources, plus the sources that failed or timed out."""
+
+    def __init__(self, items=(), degraded=None):
+        super().__init__(items)
+        self.degraded = degraded or {} # game_type -> "timeout" | "error" | "busy"
+
+# --- KEYSET CURSORS ---
+
+def match_sort_key(m):
+    """Sort key matching ORDER BY match_ts DESC, id DESC (NULL timestamps last)."""
+    return (m.match_ts is not None, m.match_ts or datetime.min, m.id)
+
+def encode_match_cursor(match_ts, match_id):
+    """Opaque cursor pointing just after the given match in the feed."""
+    raw = json.dumps([match_ts.isoformat() if match_ts else None, match_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_match_cursor(cursor):
+    try:
+        match_ts, match_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return (datetime.fromisoformat(match_ts) if match_ts else None), match_id
+    except Exception:
+        return None
+
+# --- USER SEARCH ---
+
+# Telegram user ids have at most 52 significant bits (16 digits), the oldest ones 5 digits
+TELEGRAM_ID_DIGITS = (5, 16)
+BIGINT_MAX = 2 ** 63 - 1
+
+def prefix_range(column, prefix):
+    """column >= prefix AND column < next prefix: a LIKE 'prefix%' that any index can serve."""
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return (column >= prefix) & (column < upper)
+
+def user_search_clause(q):
+    """Filter for a non-empty search `q`: username prefix (via the lower(username) index) or, for digits, telegram_id prefix.
+
+    A telegram_id starting with "12" lies in [12, 13), [120, 130), [1200, 1300), ... so the
+    prefix becomes one index range per possible id length (TELEGRAM_ID_DIGITS).
+    """
+    q = q.lower()
+    clauses = [prefix_range(func.lower(User.username), q)]
+    min_digits, max_digits = TELEGRAM_ID_DIGITS
+    if q.isascii() and q.isdigit() and q[0] != "0" and len(q) <= max_digits: # isdigit() alone takes "²"
+        n = int(q)
+        for k in range(max(min_digits - len(q), 0), max_digits - len(q) + 1):
+            low = n * 10 ** k
+            if low > BIGINT_MAX: break
+            clauses.append(User.telegram_id.between(low, min((n + 1) * 10 ** k - 1, BIGINT_MAX)))
+    return or_(*clauses)
+
+# --- READ REPLICAS ---
+
+class ReadState:
+    """Replica routing state of one request (see Database.get_session).
+
+    Reads go to the primary until `primary_until` (time.time()). A commit that wrote sets
+    `wrote` and moves `primary_until` DB_STICKY_SECONDS ahead: main.py carries it over to
+    the user's next requests in a signed cookie, whichever worker serves them.
+    """
+    __slots__ = ("primary_until", "wrote")
+
+    def __init__(self, primary_until=0.0):
+        self.primary_until = primary_until
+        self.wrote = False
+
+# ReadState of the current request, set by main.py (None outside requests: no stickiness)
+current_reader = ContextVar("current_reader", default=None)
+
+class PrimarySession(Session):
+    """Session on the primary DB. A commit that wrote something makes the current reader sticky."""
+
+@event.listens_for(PrimarySession, "after_flush")
+def _flag_flush(session, flush_context):
+    session.info["wrote"] = True
+
+@event.listens_for(PrimarySession, "do_orm_execute")
+def _flag_bulk_write(state):
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info["wrote"] = True
+
+@event.listens_for(PrimarySession, "after_commit")
+def _stick_reader(session):
+    if session.info.pop("wrote", False) and "db" in session.info:
+        session.info["db"].mark_write()
+
+def async_url(url):
+    return url.replace("sqlite://", "sqlite+aiosqlite://", 1).replace("mysql+pymysql://", "mysql+aiomysql://", 1)
+
 # --- DATABASE CLASS ---
 
+def main_db_url():
+    """URL of the Main DB: the SQLite file on Windows (local dev), MySQL otherwise."""
+    import sys
+    if sys.platform == "win32":
+        # Resolve path relative to THIS file (web_v1/database.py)
+        # We want the DB to be in the project root (one level up)
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        project_root = os.path.dirname(current_dir)
+        db_path = os.path.join(project_root, "berserk_local_v2.db")
+        return f"sqlite:///{db_path}"
+    return f"mysql+pymysql://{config.DB_USER}:{config.DB_PASS}@{config.DB_HOST}/{config.DB_NAME}"
+
 class Database:
     def __init__(self):
-        # Fallback to SQLite (Local Dev)
-        import sys
-        import os
-        if sys.platform == "win32":
-            # Resolve path relative to THIS file (web_v1/database.py)
-            # We want the DB to be in the project root (one level up)
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            project_root = os.path.dirname(current_dir)
-            db_path = os.path.join(project_root, "berserk_local_v2.db")
-            self.url = f"sqlite:///{db_path}"
-        else:
-            self.url = f"mysql+pymysql://{config.DB_USER}:{config.DB_PASS}@{config.DB_HOST}/{config.DB_NAME}"
-        
-        self.engine = create_engine(self.url, pool_recycle=3600)
+        self.url = main_db_url()
+        self.engine = make_engine(self.url, **engine_options())
         Base.metadata.create_all(self.engine) # Auto-create tables for Main DB (Users)
-        self.Session = sessionmaker(bind=self.engine)
+        self.Session = sessionmaker(bind=self.engine, class_=PrimarySession, info={"db": self})
+
+        # --- ASYNC ENGINE (same Main DB, used by async routes and the chat websocket) ---
+        self.async_url = async_url(self.url)
+        self.async_engine = make_async_engine(self.async_url, **engine_options())
+        self.AsyncSession = async_sessionmaker(
+            self.async_engine, expire_on_commit=False, sync_session_class=PrimarySession, info={"db": self}
+        )
+
+        # --- READ REPLICAS (optional copies of the Main DB for heavy reads, see get_session) ---
+        replica_urls = [url for url in getattr(config, "DB_REPLICA_URLS", []) if url]
+        self.replicas = [
+            sessionmaker(bind=make_engine(url, readonly=True, **engine_options())) for url in replica_urls
+        ]
+        self.async_replicas = [
+            async_sessionmaker(make_async_engine(async_url(url), readonly=True, **engine_options()), expire_on_commit=False)
+            for url in replica_urls
+        ]
+        self.replica_turn = count() # Round robin
+        self.sticky_seconds = getattr(config, "DB_STICKY_SECONDS", 5)
+
+        # Bounded pool for sync-only code (bot DB aggregation, background sync)
+        self.executor = ThreadPoolExecutor(
+            max_workers=getattr(config, "DB_THREAD_POOL_SIZE", 8),
+            thread_name_prefix="db-sync"
+        )
+        # Per-source queries run in pools of their own (see fan_out): they are submitted from
+        # code that already runs in `executor`, sharing it could deadlock when it is full
+        self.source_pool_size = getattr(config, "SOURCE_POOL_SIZE", 4)
+        self.source_busy = Counter() # game_type -> fan_out calls running or queued
+        self.source_timeout = getattr(config, "SOURCE_TIMEOUT", 5)
         
-        # --- CONNECT TO BOT DATABASES (Read-Only theoretically, but we use standard session) ---
-        if sys.platform == "win32":
-            cs2_path = os.path.join(project_root, "berserk_cs2_v2.db")
-            dota_path = os.path.join(project_root, "berserk_dota_v2.db")
-            
-            self.engine_cs2 = create_engine(f"sqlite:///{cs2_path}")
-            self.engine_dota = create_engine(f"sqlite:///{dota_path}")
-            
-            self.SessionCS2 = sessionmaker(bind=self.engine_cs2)
-            self.SessionDota = sessionmaker(bind=self.engine_dota)
-        else:
-            # Prod environment (MySQL) - Assuming bots use same DB or separate?
-            # For now, let's assume separate DBs on same host if configured, or just same DB.
-            # If everything is properly separated in models (CS2 vs Dota tables?), 
-            # but we use 'game_type' distinciton in 'matches' table.
-            # Users request implies separate DB FILES. On MySQL usually separate SCHEMAS.
-            # Fallback for now: Use same URL (if single DB on server) or skip if strictly file-based.
-            # Assuming Local Dev for this task context.
-            pass
+        # --- BOT DATABASES (match sources, engines are created on first use) ---
+        self.source_sessions = {} # dsn -> sessionmaker
+        self.source_writers = {} # dsn -> engine, only for backfill_sources_match_ts
+        self.source_lock = threading.Lock()
+        self.sources = self._load_sources(getattr(config, "MATCH_SOURCES", DEFAULT_MATCH_SOURCES))
+        self.source_executors = {
+            source.game_type: ThreadPoolExecutor(max_workers=self.source_pool_size, thread_name_prefix=f"db-{source.game_type}")
+            for source in self.sources
+        }
 
-    def get_session(self):
+    def get_session(self, readonly=False):
+        """Session for the Main DB. readonly=True may return a replica session (reads only,
+        data may lag behind by the replication delay): not for reads that must see a write
+        made just before, unless it was made by the current reader (read-your-writes).
+        """
+        if readonly and self.replicas and not self.reads_from_primary():
+            return self.replicas[next(self.replica_turn) % len(self.replicas)]()
         return self.Session()
-        
-    def get_cs2_session(self):
-        if hasattr(self, 'SessionCS2'): return self.SessionCS2()
-        return self.Session() # Fallback
 
-    def get_dota_session(self):
-        if hasattr(self, 'SessionDota'): return self.SessionDota()
-        return self.Session() # Fallback
+    def get_async_session(self, readonly=False):
+        """AsyncSession for the Main DB (see get_session). Use as `async with db.get_async_session() as s:`."""
+        if readonly and self.async_replicas and not self.reads_from_primary():
+            return self.async_replicas[next(self.replica_turn) % len(self.async_replicas)]()
+        return self.AsyncSession()
+
+    def mark_write(self):
+        """Sends the reads of the current request's user to the primary for DB_STICKY_SECONDS."""
+        state = current_reader.get()
+        if state is None or not self.replicas: return
+        state.wrote = True
+        state.primary_until = time.time() + self.sticky_seconds
+
+    def reads_from_primary(self):
+        state = current_reader.get()
+        return state is not None and state.primary_until > time.time()
+
+    async def run_sync(self, fn, *args, **kwargs):
+        """Runs blocking DB code in the bounded thread pool so the event loop stays free.
+
+        The caller's context (current_reader) is carried over to the thread.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, copy_context().run, partial(fn, *args, **kwargs))
+
+    async def close(self):
+        await self.async_engine.dispose()
+        for Replica in self.async_replicas:
+            await Replica.kw["bind"].dispose()
+        self.executor.shutdown(wait=False)
+        for executor in self.source_executors.values():
+            executor.shutdown(wait=False)
+        for Session in self.source_sessions.values():
+            Session.kw["bind"].dispose()
+        for engine in self.source_writers.values():
+            engine.dispose()
+
+    def _load_sources(self, entries):
+        """Builds the MatchSource registry from config entries.
+
+        Entry keys: game_type, league_name, dsn, sqlite_file and pool options
+        (SOURCE_POOL_OPTIONS). Sources with the same DSN share one engine and are
+        marked `shared`, as are sources reading the main DB.
+        """
+        project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        resolved = []
+        for entry in entries:
+            dsn = entry.get("dsn")
+            if not dsn and entry.get("sqlite_file") and self.url.startswith("sqlite"):
+                dsn = f"sqlite:///{os.path.join(project_root, entry['sqlite_file'])}"
+            resolved.append((entry, dsn or self.url))
+
+        game_types = Counter(entry["game_type"] for entry, _ in resolved)
+        duplicates = [gt for gt, n in game_types.items() if n > 1]
+        if duplicates:
+            raise ValueError(f"Duplicate match sources: {', '.join(duplicates)}")
+
+        per_dsn = Counter(dsn for _, dsn in resolved)
+        return [
+            MatchSource(
+                entry["game_type"],
+                entry.get("league_name") or entry["game_type"],
+                partial(self._source_sessionmaker, dsn, {k: entry[k] for k in SOURCE_POOL_OPTIONS if k in entry}),
+                shared=per_dsn[dsn] > 1 or dsn == self.url,
+                dsn=dsn
+            )
+            for entry, dsn in resolved
+        ]
+
+    def _source_sessionmaker(self, dsn, pool_options):
+        """sessionmaker for a source DSN, creating its engine on first use (one per DSN).
+
+        Source engines are read-only: the bots own these DBs, the web app never writes to them.
+        """
+        if dsn == self.url: return self.Session
+        Session = self.source_sessions.get(dsn)
+        if Session is None:
+            with self.source_lock:
+                Session = self.source_sessions.get(dsn)
+                if Session is None:
+                    engine = make_engine(
+                        dsn, readonly=True, query_timeout=getattr(config, "SOURCE_QUERY_TIMEOUT", 30),
+                        **{**engine_options(), **pool_options}
+                    )
+                    Session = self.source_sessions[dsn] = sessionmaker(bind=engine)
+        return Session
+
+    def _source_writer(self, dsn):
+        """Writable engine for a source DSN (one connection), see backfill_sources_match_ts."""
+        if dsn == self.url: return self.engine
+        engine = self.source_writers.get(dsn)
+        if engine is None:
+            with self.source_lock:
+                engine = self.source_writers.get(dsn)
+                if engine is None:
+                    engine = self.source_writers[dsn] = make_engine(
+                        dsn, **{**engine_options(), "pool_size": 1, "max_overflow": 0}
+                    )
+        return engine
+
+    def backfill_sources_match_ts(self):
+        """Fills match_ts of the rows the bots inserted since the last call, in every source DB.
+
+        The bots write through their own model, which leaves match_ts NULL, and the feed
+        orders by it. This is the only write the web app makes to a bot DB, on its own
+        small engine (reads keep the read-only ones). Returns the number of rows filled.
+        """
+        filled = 0
+        done = set()
+        for source in self.match_sources():
+            if source.dsn in done: continue # Sources sharing a DB are filled together
+            done.add(source.dsn)
+            try:
+                filled += backfill_match_ts(self._source_writer(source.dsn), pause=0)
+            except Exception as e:
+                logger.error(f"Source {source.game_type}: match_ts backfill failed: {e}")
+        return filled
+
+    def pool_stats(self) -> dict:
+        """Connection pool usage of the main engines and of every source engine created so far."""
+        stats = {"main": pool_stats(self.engine), "main_async": pool_stats(self.async_engine)}
+        for i, Replica in enumerate(self.replicas):
+            stats[f"replica_{i}"] = pool_stats(Replica.kw["bind"])
+        for source in self.sources:
+            Session = self.source_sessions.get(source.dsn)
+            if Session is not None: stats[source.game_type] = pool_stats(Session.kw["bind"])
+        return stats
+
+    def match_sources(self):
+        """MatchSource of every bot DB, in registry order."""
+        return self.sources
+
+    def get_source(self, game_type):
+        return next((s for s in self.sources if s.game_type == game_type), None)
+
+    def fan_out(self, fn, sources=None, timeout=None):
+        """Runs fn(source) for every source concurrently. Returns ([(source, result)], degraded).
+
+        All sources share one deadline of `timeout` seconds (SOURCE_TIMEOUT), so a call
+        takes as long as the slowest source rather than the sum. A source that raises or
+        misses the deadline is left out and reported in `degraded` as {game_type: reason};
+        a timed out query still finishes in the background (or is aborted by the driver
+        after SOURCE_QUERY_TIMEOUT).
+
+        Bulkhead: each source has its own pool of SOURCE_POOL_SIZE threads. A hanging
+        source only ties up its own threads, and once they are all taken it is reported
+        "busy" right away instead of queueing more work, so healthy sources stay fast.
+        """
+        sources = self.match_sources() if sources is None else sources
+        timeout = self.source_timeout if timeout is None else timeout
+        futures, degraded = [], {}
+        for source in sources:
+            with self.source_lock:
+                busy = self.source_busy[source.game_type] >= self.source_pool_size
+                if not busy: self.source_busy[source.game_type] += 1
+            if busy:
+                degraded[source.game_type] = "busy"
+                logger.warning(f"Source {source.game_type}: all {self.source_pool_size} threads busy")
+                continue
+            future = self.source_executors[source.game_type].submit(fn, source)
+            future.add_done_callback(partial(self._source_done, source.game_type))
+            futures.append((source, future))
+        deadline = time.monotonic() + timeout
+
+        results = []
+        for source, future in futures:
+            try:
+                results.append((source, future.result(timeout=max(deadline - time.monotonic(), 0))))
+            except FutureTimeout:
+                degraded[source.game_type] = "timeout"
+                logger.warning(f"Source {source.game_type}: no answer within {timeout}s")
+            except Exception as e:
+                degraded[source.game_type] = "error"
+                logger.error(f"Source {source.game_type}: {e}")
+        return results, degraded
+
+    def _source_done(self, game_type, future):
+        with self.source_lock:
+            self.source_busy[game_type] -= 1
 
     # --- AGGREGATION METHODS ---
 
-    def get_finished_matches_paginated(self, skip=0, limit=10):
-        """Fetches finished matches from BOTH databases, sorts by time, and paginates."""
-        matches = []
-        
-        # CS2 Matches
-        s_cs2 = self.get_cs2_session()
-        try:
-            m_cs2 = s_cs2.query(Match).filter_by(status='FINISHED').all()
-            for m in m_cs2:
-                # Force branding for any match from CS2 database
-                m.league_name = "1x1 CS2 Berserk League"
-            matches.extend(m_cs2)
-        except: pass
-        finally: s_cs2.close()
-        
-        # Dota Matches
-        s_dota = self.get_dota_session()
-        try:
-            m_dota = s_dota.query(Match).filter_by(status='FINISHED').all()
-            for m in m_dota:
-                # Force branding for any match from Dota database
-                m.league_name = "1x1 Dota2 Berserk League"
-            matches.extend(m_dota)
-        except: pass
-        finally: s_dota.close()
-        
-        # Sort desc
-        def sort_key(m):
+    def _finished_source_page(self, source, cursor, limit):
+        """One source's slice of the feed: FINISHED rows strictly older than the cursor, as FeedMatch tuples."""
+        from sqlalchemy import or_, and_
+        session = source.get_session()
+        try:
+            q = source.query(session, *(getattr(Match, c) for c in FEED_COLUMNS)).filter(Match.status == 'FINISHED')
+            if cursor:
+                last_ts, last_id = cursor
+                if last_ts is None:
+                    # Already in the NULL tail (sorted last by DESC)
+                    q = q.filter(Match.match_ts.is_(None), Match.id < last_id)
+                else:
+                    q = q.filter(or_(
+                        Match.match_ts < last_ts,
+                        and_(Match.match_ts == last_ts, Match.id < last_id),
+                        Match.match_ts.is_(None)
+                    ))
+            rows = q.order_by(Match.match_ts.desc(), Match.id.desc()).limit(limit).all()
+            # Force branding for any match from this database
+            return [FeedMatch(*row, source.game_type, source.league_name, 0, 0, (), None) for row in rows]
+        finally: session.close()
+
+    def get_finished_matches_paginated(self, skip=0, limit=10, cursor=None, with_maps=True):
+        """Fetches finished matches from ALL sources, newest first, as SourceResults of FeedMatch tuples.
+
+        Each source returns at most one page ordered by (match_ts, id), queried concurrently
+        (see fan_out). The pages are merged lazily with a heap and every match gets a `cursor` for the next call.
+        `skip` is kept for old clients and costs skip+limit rows per source (the API caps it).
+        Matches whose match_time could not be parsed (NULL match_ts) come last.
+        Without `with_maps` the match_maps read is skipped and `maps` stays empty.
+        """
+        decoded = decode_match_cursor(cursor) if cursor else None
+        if decoded: skip = 0
+        per_source = skip + limit
+
+        pages, degraded = self.fan_out(lambda source: self._finished_source_page(source, decoded, per_source))
+        merged = heapq.merge(*(rows for _, rows in pages), key=match_sort_key, reverse=True)
+        page = list(islice(merged, skip, skip + limit))
+
+        maps = self.get_match_maps((m.source, m.id) for m in page) if with_maps else {}
+        return SourceResults([
+            m._replace(
+                s1=scores[0], s2=scores[1], cursor=encode_match_cursor(m.match_ts, m.id),
+                maps=[
+                    {"map_no": mp.map_no, "s1": mp.s1, "s2": mp.s2, "winner_side": mp.winner_side}
+                    for _, mp in sorted(maps.get((m.source, m.id), {}).items())
+                ]
+            )
+            for m in page
+            for scores in (parse_score(m.score) or (0, 0),)
+        ], degraded)
+
+    def _attach_scores(self, matches):
+        """Sets integer s1/s2 and `maps` ({map_no: MatchMap}) on matches tagged with their `source`."""
+        maps = self.get_match_maps((m.source, m.id) for m in matches)
+        for m in matches:
+            m.s1, m.s2 = parse_score(m.score) or (0, 0)
+            m.maps = maps.get((m.source, m.id), {})
+
+    def iter_finished_matches(self, game_type=None, since=None, batch_size=1000):
+        """Streams the FINISHED matches of every source (or one game_type) for exports.
+
+        Each source is read through a server-side cursor (yield_per), so only one batch
+        is held in memory however long the history is. Sources come one after another,
+        each ordered by (updated_at, id), so watermarks are per source: `since` is a
+        {game_type: largest updated_at received} dict (a source missing from it is sent
+        in full). A single datetime applies to every source, which is only safe for a
+        one-source export: a row committed to an earlier source while a later one is
+        streamed can be older than the later source's newest row.
+        Rows from SYNC_OVERLAP_SECONDS before a watermark are sent again (same-second and
+        late commits, see _finished_batches): clients upsert by id.
+        """
+        overlap = timedelta(seconds=getattr(config, "SYNC_OVERLAP_SECONDS", 10))
+        for source in self.match_sources():
+            if game_type and source.game_type != game_type: continue
+            source_since = since.get(source.game_type) if isinstance(since, dict) else since
+            session = source.get_session()
             try:
-                # Try datetime
-                if isinstance(m.match_time, datetime): return m.match_time
-                # Try parsing
-                if len(str(m.match_time)) > 10:
-                     return datetime.strptime(str(m.match_time), '%Y-%m-%d %H:%M:%S')
-                return datetime.strptime(str(m.match_time), '%Y-%m-%d %H:%M')
-            except:
-                return datetime.min
-
-        matches.sort(key=sort_key, reverse=True)
-        
-        # Paginate
-        return matches[skip : skip + limit]
+                q = source.query(session, Match).filter(Match.status == 'FINISHED')
+                if source_since: q = q.filter(Match.updated_at >= source_since - overlap)
+                rows = iter(q.order_by(Match.updated_at.asc(), Match.id.asc()).yield_per(batch_size))
+                while True:
+                    batch = list(islice(rows, batch_size))
+                    if not batch: break
+                    for m in batch:
+                        m.league_name = source.league_name
+                        m.source = source.game_type
+                    self._attach_scores(batch)
+                    yield from batch
+            finally: session.close()
 
-    def get_team_matches(self, team_name):
-        """Fetches all finished matches for a team from ALL DBs."""
-        matches = []
-        from sqlalchemy import or_
-        
-        # CS2
-        s_cs2 = self.get_cs2_session()
-        try:
-            m = s_cs2.query(Match).filter(or_(Match.team1 == team_name, Match.team2 == team_name)).filter_by(status='FINISHED').all()
-            for item in m:
-                item.league_name = "1x1 CS2 Berserk League"
-            matches.extend(m)
-        except: pass
-        finally: s_cs2.close()
-
-        # Dota
-        s_dota = self.get_dota_session()
-        try:
-            m = s_dota.query(Match).filter(or_(Match.team1 == team_name, Match.team2 == team_name)).filter_by(status='FINISHED').all()
-            for item in m:
-                item.league_name = "1x1 Dota2 Berserk League"
-            matches.extend(m)
-        except: pass
-        finally: s_dota.close()
-        
-        return matches
+    # --- TEAM INDEX SYNC ---
+
+    def _get_watermark(self, session, key):
+        state = session.get(SyncState, key)
+        if not state or not state.value: return None
+        ts, match_id = json.loads(state.value)
+        return (datetime.fromisoformat(ts) if ts else None), match_id
+
+    def _set_watermark(self, session, key, ts, match_id):
+        state = session.get(SyncState, key)
+        if not state:
+            state = SyncState(key=key)
+            session.add(state)
+        state.value = json.dumps([ts.isoformat() if ts else None, match_id])
+
+    def _finished_batches(self, source, watermark, batch_size):
+        """Yields FINISHED matches changed after the (updated_at, id) watermark, oldest first, in batches.
+
+        The first batch starts SYNC_OVERLAP_SECONDS before the watermark: MySQL DATETIME
+        keeps whole seconds, so a row updated in the watermark's second with a smaller id,
+        or committed late with an older updated_at, would otherwise be skipped for good.
+        Re-read rows are harmless, the caller compares them with what it indexed.
+        """
+        from sqlalchemy import or_, and_
+        overlap = timedelta(seconds=getattr(config, "SYNC_OVERLAP_SECONDS", 10))
+        first = True
+        while True:
+            session = source.get_session()
+            try:
+                q = source.query(session, Match).filter(Match.status == 'FINISHED')
+                if watermark:
+                    last_ts, last_id = watermark
+                    if first and last_ts is not None:
+                        q = q.filter(Match.updated_at >= last_ts - overlap)
+                    elif last_ts is None:
+                        # Still in the NULL head (sorted first by ASC)
+                        q = q.filter(or_(
+                            and_(Match.updated_at.is_(None), Match.id > last_id),
+                            Match.updated_at.isnot(None)
+                        ))
+                    else:
+                        q = q.filter(or_(
+                            Match.updated_at > last_ts,
+                            and_(Match.updated_at == last_ts, Match.id > last_id)
+                        ))
+                batch = q.order_by(Match.updated_at.asc(), Match.id.asc()).limit(batch_size).all()
+                source.attach_optional(session, batch)
+            finally: session.close()
+
+            if not batch: return
+            yield batch
+            first = False
+            watermark = (batch[-1].updated_at, batch[-1].id)
+
+    def sync_team_matches(self, batch_size=500):
+        """Adds matches that became FINISHED since the last run to the team_matches index.
+
+        Follows every bot DB by its updated_at watermark, so a run only touches new rows.
+        A source that fails is logged and skipped, it catches up on a later run.
+        Returns (added, changed): the TeamMatch rows that were not indexed before, and those
+        of already indexed matches whose result or time was corrected.
+        """
+        added = []
+        changed = []
+        main = self.get_session()
+        try:
+            for source in self.match_sources():
+                try:
+                    self._sync_source_team_matches(main, source, batch_size, added, changed)
+                except Exception as e:
+                    main.rollback()
+                    logger.error(f"Source {source.game_type}: team index sync failed: {e}")
+        finally: main.close()
+        return added, changed
+
+    def _sync_source_team_matches(self, main, source, batch_size, added, changed):
+        """sync_team_matches of one source. Rows of every committed batch are appended to added/changed."""
+        game_type = source.game_type
+        key = f"team_matches:{game_type}"
+        for batch in self._finished_batches(source, self._get_watermark(main, key), batch_size):
+            changes = []
+            new_teams = set()
+            batch_added, batch_changed = [], []
+            maps_by_match = self._replace_match_maps(main, game_type, batch)
+            for m in batch:
+                for row in team_match_rows(m, game_type, maps_by_match[m.id]):
+                    old = main.get(TeamMatch, (row.team, row.game_type, row.match_id))
+                    if old is None:
+                        batch_added.append(row)
+                        new_teams.add(row.team)
+                    elif old.counts() != row.counts() or old.match_ts != row.match_ts:
+                        batch_changed.append(row)
+                    else:
+                        main.merge(row) # Re-read (watermark overlap) or a change stats don't see
+                        continue
+                    changes.append((old.counts() if old else None, row))
+                    main.merge(row)
+            self._apply_team_stats(main, changes)
+            for team in new_teams:
+                main.merge(CatalogTeam(game_type=game_type, team=team))
+            self._set_watermark(main, key, batch[-1].updated_at, batch[-1].id)
+            main.commit()
+            added += batch_added
+            changed += batch_changed
+        if main.get(SyncState, key) is None:
+            # Empty source: still mark it as synced
+            main.add(SyncState(key=key))
+            main.commit()
+
+    # --- MAP SCORES ---
+
+    def _replace_match_maps(self, session, game_type, matches):
+        """Writes the MatchMap rows of `matches`, replacing earlier ones. Returns {match_id: rows}."""
+        rows = {m.id: match_map_rows(m, game_type) for m in matches}
+        if rows:
+            session.query(MatchMap).filter(
+                MatchMap.game_type == game_type, MatchMap.match_id.in_(list(rows))
+            ).delete(synchronize_session=False)
+            session.add_all(row for maps in rows.values() for row in maps)
+        return rows
+
+    def convert_match_maps(self, batch_size=500):
+        """Batched converter: fills match_maps for FINISHED matches indexed before the table existed.
+
+        Walks every source in id order with a commit per batch and keeps its position in
+        sync_state, so it resumes after a restart and costs one read per source once done.
+        Matches that finish later are converted by sync_team_matches.
+        Returns the number of converted matches.
+        """
+        converted = 0
+        main = self.get_session()
+        try:
+            for source in self.match_sources():
+                game_type = source.game_type
+                key = f"match_maps:{game_type}"
+                try:
+                    state = main.get(SyncState, key)
+                    if state is None:
+                        state = SyncState(key=key, value="")
+                        main.add(state)
+                    while state.value != "done":
+                        session = source.get_session()
+                        try:
+                            batch = (
+                                source.query(session, Match)
+                                .filter(Match.status == 'FINISHED', Match.id > (state.value or ""))
+                                .order_by(Match.id)
+                                .limit(batch_size)
+                                .all()
+                            )
+                            source.attach_optional(session, batch)
+                        finally: session.close()
+                        self._replace_match_maps(main, game_type, batch)
+                        converted += len(batch)
+                        state.value = batch[-1].id if batch else "done"
+                        main.commit()
+                except Exception as e:
+                    main.rollback()
+                    logger.error(f"Source {game_type}: map score conversion failed: {e}")
+        finally: main.close()
+        return converted
+
+    def get_match_maps(self, refs):
+        """{(game_type, match_id): {map_no: MatchMap}} for (game_type, match_id) refs, one read per source."""
+        ids_by_source = {}
+        for game_type, match_id in refs:
+            ids_by_source.setdefault(game_type, []).append(match_id)
+        found = {}
+        session = self.get_session()
+        try:
+            for game_type, ids in ids_by_source.items():
+                for mp in session.query(MatchMap).filter(MatchMap.game_type == game_type, MatchMap.match_id.in_(ids)):
+                    found.setdefault((game_type, mp.match_id), {})[mp.map_no] = mp
+        finally: session.close()
+        return found
+
+    def try_acquire_lease(self, name, owner, ttl=90):
+        """Cross-process leader lease in sync_state. True if `owner` holds `name` for the next `ttl` seconds.
+
+        Lets N web workers share one background job: the holder renews it every run,
+        the others take over once it has not been renewed for `ttl` seconds.
+        """
+        from sqlalchemy.exc import IntegrityError
+        table = SyncState.__table__
+        key = f"lease:{name}"
+        now = datetime.now()
+
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                table.update()
+                .where(table.c.key == key, or_(table.c.value == owner, table.c.updated_at < now - timedelta(seconds=ttl)))
+                .values(value=owner, updated_at=now)
+            )
+            if result.rowcount: return True
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(table.insert().values(key=key, value=owner, updated_at=now))
+            return True
+        except IntegrityError:
+            return False
+
+    # --- PRINCIPALS ---
+
+    def touch_principals(self, session, telegram_ids=None):
+        """Marks users as changed for every process caching them (None = all users). Caller commits."""
+        now = datetime.now()
+        keys = ["principal:*"] if telegram_ids is None else [f"principal:{tg_id}" for tg_id in telegram_ids]
+        for key in keys:
+            state = session.get(SyncState, key)
+            if not state:
+                state = SyncState(key=key)
+                session.add(state)
+            state.updated_at = now
+
+    def touch_versions(self, names, session=None):
+        """Marks data versions ("matches", "disciplines", ...) as changed for every web worker.
+
+        With a session the caller commits, otherwise the marker is committed right away.
+        """
+        own = session is None
+        if own: session = self.get_session()
+        try:
+            now = datetime.now()
+            for name in names:
+                key = f"version:{name}"
+                state = session.get(SyncState, key)
+                if not state:
+                    state = SyncState(key=key)
+                    session.add(state)
+                state.updated_at = now
+            if own: session.commit()
+        finally:
+            if own: session.close()
+
+    def changed_markers(self, since):
+        """([(key, updated_at)] of principal and version markers touched since `since`, next `since`)."""
+        # Overlap of 2s: MySQL DATETIME rounds to seconds and the clocks of the writers may lag a bit
+        next_since = datetime.now() - timedelta(seconds=2)
+        session = self.get_session()
+        try:
+            markers = session.query(SyncState.key, SyncState.updated_at).filter(
+                or_(SyncState.key.like('principal:%'), SyncState.key.like('version:%')),
+                SyncState.updated_at >= since
+            ).all()
+        finally: session.close()
+        return [tuple(m) for m in markers], next_since
+
+    # --- ADMIN USERS ---
+
+    def get_users_page(self, cursor=None, limit=50, premium=None, banned=None, admin=None, q=None):
+        """One page of the admin user list, newest first. Returns (users, next cursor or None).
+
+        Keyset pagination on (created_at, id): pass the returned cursor for the next page.
+        premium / banned / admin filter on the flag when not None. `q` is a prefix of the
+        username (case-insensitive) or of the telegram_id, both served by an index.
+        """
+        from sqlalchemy import and_
+        session = self.get_session(readonly=True)
+        try:
+            query = session.query(User)
+            for column, value in ((User.is_premium, premium), (User.is_banned, banned), (User.is_admin, admin)):
+                if value is not None: query = query.filter(column == value)
+            q = (q or "").strip().lstrip("@")
+            if q:
+                query = query.filter(user_search_clause(q))
+            decoded = decode_match_cursor(cursor) if cursor else None
+            if decoded:
+                last_ts, last_id = decoded
+                if last_ts is None:
+                    # Already in the NULL tail (sorted last by DESC)
+                    query = query.filter(User.created_at.is_(None), User.id < last_id)
+                else:
+                    query = query.filter(or_(
+                        User.created_at < last_ts,
+                        and_(User.created_at == last_ts, User.id < last_id),
+                        User.created_at.is_(None)
+                    ))
+            users = query.order_by(User.created_at.desc(), User.id.desc()).limit(limit + 1).all()
+        finally: session.close()
+
+        next_cursor = None
+        if len(users) > limit:
+            users = users[:limit]
+            next_cursor = encode_match_cursor(users[-1].created_at, users[-1].id)
+        return users, next_cursor
+
+    # --- TEAM STATS ---
+
+    def _apply_team_stats(self, session, changes):
+        """Applies (old counts, new row) index changes to team_stats.
+
+        All-time counters move by the delta. The recent window cannot be kept with counters
+        alone, so it is recounted from the top TEAM_STATS_WINDOW index rows of each touched team.
+        """
+        touched = {}
+        for old_counts, row in changes:
+            stats = touched.get(row.team) or session.get(TeamStats, row.team)
+            if stats is None:
+                stats = TeamStats(team=row.team, **{f: 0 for f in TeamStats.ALL_TIME + TeamStats.RECENT})
+                session.add(stats)
+            touched[row.team] = stats
+            if old_counts:
+                stats.add(old_counts, sign=-1)
+            stats.add(row.counts())
+
+        session.flush()
+        for team, stats in touched.items():
+            recent = (
+                session.query(TeamMatch)
+                .filter(TeamMatch.team == team)
+                .order_by(TeamMatch.match_ts.desc())
+                .limit(TEAM_STATS_WINDOW)
+                .all()
+            )
+            totals = [sum(c) for c in zip(*(r.counts() for r in recent))] or [0] * len(TeamStats.RECENT)
+            for field, value in zip(TeamStats.RECENT, totals):
+                setattr(stats, field, value)
+
+    def get_team_stats(self, team_name):
+        """Aggregated stats row for a team, or None if it has no finished games."""
+        session = self.get_session(readonly=True)
+        try:
+            return session.get(TeamStats, team_name)
+        finally: session.close()
+
+    def get_team_form(self, team_name, n=5):
+        """Won flags of the team's last n games, oldest first."""
+        session = self.get_session(readonly=True)
+        try:
+            rows = (
+                session.query(TeamMatch.won)
+                .filter(TeamMatch.team == team_name)
+                .order_by(TeamMatch.match_ts.desc())
+                .limit(n)
+                .all()
+            )
+            return [1 if won else 0 for (won,) in reversed(rows)]
+        finally: session.close()
+
+    def get_team_match_columns(self):
+        """(team, opponent, match_ts, won, map1_won, first_blood) of every index row, for the prediction engine."""
+        table = TeamMatch.__table__
+        with self.engine.connect() as conn:
+            return conn.execute(select(
+                table.c.team, table.c.opponent, table.c.match_ts,
+                table.c.won, table.c.map1_won, table.c.first_blood
+            )).all()
+
+    def get_team_catalog(self):
+        """All (game_type, team) pairs. Fills team_catalog from team_matches the first time."""
+        session = self.get_session()
+        try:
+            if session.get(SyncState, "team_catalog") is None:
+                # Teams indexed before the catalog existed
+                for game_type, team in session.query(TeamMatch.game_type, TeamMatch.team).distinct():
+                    session.merge(CatalogTeam(game_type=game_type, team=team))
+                session.add(SyncState(key="team_catalog"))
+                session.commit()
+            return [tuple(p) for p in session.query(CatalogTeam.game_type, CatalogTeam.team)]
+        finally: session.close()
+
+    # --- RATINGS ---
+
+    def _store_ratings(self, session, game_type, engine):
+        for team, (rating, rd, games, last_ts) in engine.ratings.items():
+            session.merge(TeamRating(team=team, game_type=game_type, rating=rating, rd=rd, games=games, last_ts=last_ts))
+
+    def _replay_ratings(self, session, game_type, engine):
+        """Feeds every indexed result of a league to `engine` in time order. Returns the replay metrics."""
+        q = (
+            session.query(TeamMatch.team, TeamMatch.opponent, TeamMatch.won, TeamMatch.match_ts, TeamMatch.match_id)
+            .filter(TeamMatch.game_type == game_type, TeamMatch.is_home.is_(True))
+            .order_by(TeamMatch.match_ts.asc(), TeamMatch.match_id.asc())
+            .yield_per(1000)
+        )
+        last = []
+        def results():
+            for team, opponent, won, match_ts, match_id in q:
+                last[:] = [match_ts, match_id]
+                if opponent and won is not None:
+                    yield team, opponent, int(won), match_ts
+        metrics = engine.replay(results())
+        metrics["last"] = tuple(last) or None
+        return metrics
+
+    def sync_ratings(self, added=(), changed=()):
+        """Catch-up: feeds newly indexed matches (sync_team_matches rows) to the ratings of their league.
+
+        Costs O(new matches). A league is replayed from scratch instead when it was never
+        rated, a new match is not newer than the last rated one (late result) or a rated
+        match was corrected (`changed` rows), so stored ratings always equal a full replay
+        in time order.
+        Returns {game_type: "replay" | number of rated matches} for the leagues that changed.
+        """
+        rated = {}
+        main = self.get_session()
+        try:
+            for game_type in (s.game_type for s in self.match_sources()):
+                key = f"ratings:{game_type}"
+                new = sorted(
+                    (r for r in added if r.game_type == game_type and r.is_home),
+                    key=lambda r: rating_order(r.match_ts, r.match_id)
+                )
+                watermark = self._get_watermark(main, key)
+                if main.get(SyncState, key) is None or any(r.game_type == game_type for r in changed) or (
+                    new and watermark and rating_order(new[0].match_ts, new[0].match_id) <= rating_order(*watermark)
+                ):
+                    main.query(TeamRating).filter(TeamRating.game_type == game_type).delete(synchronize_session=False)
+                    engine = RatingEngine()
+                    last = self._replay_ratings(main, game_type, engine)["last"]
+                    rated[game_type] = "replay"
+                elif new:
+                    engine = RatingEngine()
+                    teams = {r.team for r in new} | {r.opponent for r in new if r.opponent}
+                    for t in main.query(TeamRating).filter(TeamRating.game_type == game_type, TeamRating.team.in_(teams)):
+                        engine.load(t.team, t.rating, t.rd, t.games, t.last_ts)
+                    for r in new:
+                        if r.opponent and r.won is not None:
+                            engine.apply(r.team, r.opponent, int(r.won), r.match_ts)
+                    last = (new[-1].match_ts, new[-1].match_id)
+                    rated[game_type] = len(new)
+                else:
+                    continue
+                self._store_ratings(main, game_type, engine)
+                self._set_watermark(main, key, *(last or (None, "")))
+                main.commit()
+        finally: main.close()
+        return rated
+
+    def rebuild_ratings(self, store=True, **params):
+        """Full replay of every league with RatingEngine(**params) (config defaults if empty).
+
+        With store=False nothing is written: use it to compare parameters by the returned
+        {game_type: metrics} (log_loss, accuracy).
+        """
+        metrics = {}
+        main = self.get_session()
+        try:
+            for game_type in (s.game_type for s in self.match_sources()):
+                engine = RatingEngine(**params)
+                if store:
+                    main.query(TeamRating).filter(TeamRating.game_type == game_type).delete(synchronize_session=False)
+                result = self._replay_ratings(main, game_type, engine)
+                last = result.pop("last")
+                metrics[game_type] = result
+                if store:
+                    self._store_ratings(main, game_type, engine)
+                    self._set_watermark(main, f"ratings:{game_type}", *(last or (None, "")))
+                    main.commit()
+        finally: main.close()
+        return metrics
+
+    def get_team_ratings(self):
+        """{team: (rating, rd)}, from the league the team played most games in."""
+        session = self.get_session()
+        try:
+            rows = session.query(TeamRating.team, TeamRating.rating, TeamRating.rd, TeamRating.games).order_by(TeamRating.games.asc())
+            return {team: (rating, rd) for team, rating, rd, _ in rows}
+        finally: session.close()
+
+    def get_team_rating(self, team_name):
+        """TeamRating of the team's main league (most games), or None if it is not rated yet."""
+        session = self.get_session(readonly=True)
+        try:
+            return session.query(TeamRating).filter(TeamRating.team == team_name).order_by(TeamRating.games.desc()).first()
+        finally: session.close()
+
+    # --- PREDICTIONS ---
+
+    def get_upcoming_matches(self):
+        """(game_type, match_id, team1, team2, match_ts) of every UPCOMING match in the bot DBs,
+        as SourceResults: sources are read concurrently and a failing one is left out (see fan_out)."""
+        def read(source):
+            session = source.get_session()
+            try:
+                rows = (
+                    source.query(session, Match.id, Match.team1, Match.team2, Match.match_ts, Match.match_time)
+                    .filter(Match.status == 'UPCOMING')
+                    .all()
+                )
+            finally: session.close()
+            return [
+                (source.game_type, match_id, team1, team2, match_ts or parse_match_time(match_time))
+                for match_id, team1, team2, match_ts, match_time in rows
+            ]
+
+        results, degraded = self.fan_out(read)
+        return SourceResults((row for _, rows in results for row in rows), degraded)
+
+    def sync_predictions(self, predict_many, teams=None):
+        """Brings match_predictions in line with the UPCOMING matches of every source.
+
+        New and changed matches are scored with `predict_many`, matches that are no longer
+        upcoming are dropped. Of the rest only those involving one of `teams` (the teams of
+        newly finished matches) are rescored, all of them if `teams` is None.
+        Predictions of a source that could not be read are kept as they are.
+        Returns the number of rows written or deleted.
+        """
+        rows = self.get_upcoming_matches()
+        upcoming = {(g, mid): (t1, t2, ts) for g, mid, t1, t2, ts in rows if t1 and t2}
+        session = self.get_session()
+        try:
+            stored = {(p.game_type, p.match_id): p for p in session.query(MatchPrediction)}
+            gone = [p for key, p in stored.items() if key not in upcoming and p.game_type not in rows.degraded]
+            todo = [
+                key for key, (team1, team2, match_ts) in upcoming.items()
+                if teams is None or key not in stored
+                or (stored[key].team1, stored[key].team2, stored[key].match_ts) != (team1, team2, match_ts)
+                or team1 in teams or team2 in teams
+            ]
+            for p in gone:
+                session.delete(p)
+
+            now = datetime.now()
+            results = predict_many([upcoming[key][:2] for key in todo])
+            for (game_type, match_id), result in zip(todo, results):
+                team1, team2, match_ts = upcoming[(game_type, match_id)]
+                session.merge(MatchPrediction(
+                    game_type=game_type, match_id=match_id, team1=team1, team2=team2, match_ts=match_ts,
+                    winner=result["winner"], confidence=result["confidence"],
+                    first_blood_rate=result["stats"]["first_blood_rate"], updated_at=now
+                ))
+            session.commit()
+            return len(gone) + len(todo)
+        finally: session.close()
+
+    def get_stored_prediction(self, team1, team2):
+        """Stored prediction of an upcoming team1 vs team2 match, or None (one read on the team pair index)."""
+        session = self.get_session(readonly=True)
+        try:
+            return session.query(MatchPrediction).filter_by(team1=team1, team2=team2).first()
+        finally: session.close()
+
+    def get_predictions(self, game_type=None, limit=100):
+        """Stored predictions of upcoming matches, soonest first."""
+        session = self.get_session(readonly=True)
+        try:
+            q = session.query(MatchPrediction)
+            if game_type: q = q.filter(MatchPrediction.game_type == game_type)
+            return q.order_by(MatchPrediction.match_ts.asc()).limit(limit).all()
+        finally: session.close()
+
+    def rebuild_team_stats(self):
+        """Full recompute: drops the derived team tables and replays every FINISHED match."""
+        tables = [TeamMatch.__table__, TeamStats.__table__, CatalogTeam.__table__, TeamRating.__table__, MatchPrediction.__table__]
+        Base.metadata.drop_all(self.engine, tables=tables)
+        Base.metadata.create_all(self.engine, tables=tables)
+
+        session = self.get_session()
+        try:
+            session.query(SyncState).filter(SyncState.key.like('team_matches:%')).delete(synchronize_session=False)
+            session.query(SyncState).filter(SyncState.key.like('ratings:%')).delete(synchronize_session=False)
+            session.query(SyncState).filter_by(key="team_catalog").delete(synchronize_session=False)
+            session.commit()
+        finally: session.close()
+        added, _ = self.sync_team_matches()
+        return added
+
+    # --- CHAT ---
+
+    def insert_chat_messages(self, batch):
+        """Group commit for the chat write-behind buffer. Returns {provisional_id: id}.
+
+        Replies to messages that do not exist (trimmed by retention, or a made-up id) are
+        stored as plain messages. If the batch still fails, its messages are written one
+        by one so a bad message only fails itself: it is missing from the result.
+        """
+        targets = {m["reply_to_id"] for m in batch if isinstance(m["reply_to_id"], int) and m["reply_to_id"] > 0}
+        session = self.get_session()
+        try:
+            existing = set()
+            if targets:
+                existing = {i for (i,) in session.query(ChatMessage.id).filter(ChatMessage.id.in_(targets))}
+
+            def build(m):
+                row = ChatMessage(user_id=m["user_id"], content=m["content"], created_at=m["created_at"])
+                if m["reply_to_id"] in existing:
+                    row.reply_to_id = m["reply_to_id"]
+                return row
+
+            rows = {}
+            for m in batch:
+                row = rows[m["provisional_id"]] = build(m)
+                if m["reply_to_id"] in rows:
+                    row.reply_to = rows[m["reply_to_id"]] # Reply to a message of the same batch
+            try:
+                session.add_all(rows.values())
+                session.flush()
+                ids = {pid: row.id for pid, row in rows.items()} # Read before commit expires the rows
+                session.commit()
+                return ids
+            except Exception as e:
+                session.rollback()
+                logger.warning(f"Chat batch of {len(batch)} failed, writing messages one by one: {e}")
+
+            ids = {}
+            for m in batch:
+                row = build(m)
+                if m["reply_to_id"] in ids:
+                    row.reply_to_id = ids[m["reply_to_id"]]
+                try:
+                    session.add(row)
+                    session.flush()
+                    ids[m["provisional_id"]] = row.id
+                    session.commit()
+                except Exception as e:
+                    session.rollback()
+                    ids.pop(m["provisional_id"], None)
+                    logger.error(f"Chat message {m['provisional_id']} not written: {e}")
+            return ids
+        finally: session.close()
+
+    def trim_chat_messages(self, keep=100):
+        """Retention: keeps the newest `keep` messages. Returns the number of deleted rows."""
+        session = self.get_session()
+        try:
+            cutoff = session.query(ChatMessage.id).order_by(ChatMessage.id.desc()).offset(keep).limit(1).scalar()
+            if cutoff is None: return 0
+            deleted = session.query(ChatMessage).filter(ChatMessage.id <= cutoff).delete(synchronize_session=False)
+            session.commit()
+            return deleted
+        finally: session.close()
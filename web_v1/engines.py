@@ -0,0 +1,96 @@
+"""Engine factory shared by the web app (database.py) and the payment bot (bot_payment/database.py).
+
+Settings are passed in by the caller: both apps have their own `config` module.
+"""
+from functools import partial
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine
+
+POOL_SIZE = 10
+MAX_OVERFLOW = 10
+POOL_RECYCLE = 3600
+POOL_TIMEOUT = 30
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
+def is_sqlite(url):
+    return url.startswith("sqlite")
+
+def sqlite_pragmas(readonly=False, busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS, mmap_size=SQLITE_MMAP_SIZE):
+    """Per-connection PRAGMAs: WAL so readers don't block the writer (and the other way round),
+    synchronous=NORMAL (safe with WAL, one fsync per checkpoint instead of per commit),
+    a busy timeout instead of instant "database is locked" errors, and memory-mapped reads.
+
+    Read-only connections leave the journal mode to the file's writer and refuse writes.
+    """
+    pragmas = [f"PRAGMA busy_timeout = {int(busy_timeout_ms)}", f"PRAGMA mmap_size = {int(mmap_size)}"]
+    if readonly:
+        pragmas.append("PRAGMA query_only = ON")
+    else:
+        pragmas += ["PRAGMA journal_mode = WAL", "PRAGMA synchronous = NORMAL"]
+    return pragmas
+
+def _run_on_connect(statements, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for statement in statements:
+            cursor.execute(statement)
+    finally: cursor.close()
+
+def _options(url, readonly, pool_size, max_overflow, pool_recycle, pool_timeout, pool_pre_ping,
+             busy_timeout_ms, mmap_size):
+    """(create_engine kwargs, statements to run on every new connection)."""
+    options = {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_recycle": pool_recycle,
+        "pool_timeout": pool_timeout,
+        "pool_pre_ping": pool_pre_ping,
+    }
+    if is_sqlite(url):
+        # Pooled connections move between the request threads
+        options["connect_args"] = {"check_same_thread": False, "timeout": busy_timeout_ms / 1000}
+        return options, sqlite_pragmas(readonly, busy_timeout_ms, mmap_size)
+    return options, ["SET SESSION TRANSACTION READ ONLY"] if readonly else []
+
+def make_engine(url, readonly=False, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW, pool_recycle=POOL_RECYCLE,
+                pool_timeout=POOL_TIMEOUT, pool_pre_ping=False, busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS,
+                mmap_size=SQLITE_MMAP_SIZE, query_timeout=None):
+    """Sync engine with explicit pool sizing (and the SQLite PRAGMA profile for SQLite URLs).
+
+    query_timeout (seconds, MySQL only) makes the driver give up on a connect or a query
+    that hangs, instead of holding its thread forever. SQLite waits are bounded by busy_timeout.
+    """
+    options, statements = _options(url, readonly, pool_size, max_overflow, pool_recycle, pool_timeout,
+                                   pool_pre_ping, busy_timeout_ms, mmap_size)
+    if query_timeout and not is_sqlite(url):
+        options["connect_args"] = {"connect_timeout": int(query_timeout), "read_timeout": int(query_timeout)}
+    engine = create_engine(url, **options)
+    if statements:
+        event.listen(engine, "connect", partial(_run_on_connect, statements))
+    return engine
+
+def make_async_engine(url, readonly=False, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW, pool_recycle=POOL_RECYCLE,
+                      pool_timeout=POOL_TIMEOUT, pool_pre_ping=False, busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS,
+                      mmap_size=SQLITE_MMAP_SIZE):
+    """Async counterpart of make_engine (aiosqlite / aiomysql URLs)."""
+    options, statements = _options(url, readonly, pool_size, max_overflow, pool_recycle, pool_timeout,
+                                   pool_pre_ping, busy_timeout_ms, mmap_size)
+    if is_sqlite(url):
+        options["connect_args"].pop("check_same_thread")
+    engine = create_async_engine(url, **options)
+    if statements:
+        event.listen(engine.sync_engine, "connect", partial(_run_on_connect, statements))
+    return engine
+
+def pool_stats(engine) -> dict:
+    """Size and usage of an engine's connection pool (sync or async engine)."""
+    pool = getattr(engine, "sync_engine", engine).pool
+    stats = {"pool": type(pool).__name__}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, name, None)
+        if method: stats[name] = method()
+    if "overflow" in stats:
+        stats["overflow"] = max(stats["overflow"], 0) # Counts from -size while the pool is not full
+    return stats
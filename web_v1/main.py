@@ -1,11 +1,17 @@
 from fastapi import FastAPI, Request, HTTPException, Depends, Cookie, Query
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
 import uvicorn
+import asyncio
+import csv
+import io
 import hashlib
 import hmac
+import math
 from datetime import datetime, timedelta
 
 
@@ -14,9 +20,23 @@ import logging
 
 import config
 import config
-from database import Database, User, Match, Discipline, StreamChannel, ChatMessage
+from database import Database, User, Discipline, StreamChannel, ChatMessage, FeedMatch, ReadState, current_reader
+from broadcast import ConnectionManager
+from chat_history import ChatHistory, message_payload
+from chat_writer import ChatWriter
+from pubsub import WORKER_ID, create_pubsub
+from catalog import TeamCatalog
+from predictor import PredictionEngine
+from ratings import RatingEngine
+from payloads import FastJSONResponse, compile_mapper, dumps
+from page_cache import Fragment, PageCache, Payload, http_date, not_modified, user_fingerprint, user_role
+from auth import (
+    PRIMARY_COOKIE, SESSION_COOKIE, SESSION_MAX_AGE, Principal, PrincipalCache,
+    sign_primary_until, sign_session, verify_primary_until, verify_session,
+)
 from fastapi import Form, WebSocket, WebSocketDisconnect
 from typing import List
+from pydantic import BaseModel
 
 # LOGGING
 logging.basicConfig(level=logging.INFO)
@@ -33,6 +53,95 @@ def get_db():
     finally:
         session.close()
 
+async def get_async_read_db():
+    """Async session dependency for read-only routes (served by a read replica when there is one),
+    so DB waits don't block the event loop."""
+    async with db.get_async_session(readonly=True) as session:
+        yield session
+
+# Resolved users by telegram_id, so the common request path does not touch the DB
+principals = PrincipalCache(
+    maxsize=getattr(config, "PRINCIPAL_CACHE_SIZE", 10000),
+    ttl=getattr(config, "PRINCIPAL_CACHE_TTL", 60)
+)
+
+def load_principal(telegram_id):
+    session = db.get_session()
+    try:
+        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+        if not user: return None
+        if user.is_banned and user.ban_until and user.ban_until < datetime.now():
+            # Temporary ban is over
+            user.is_banned = False
+            user.ban_until = None
+            db.touch_principals(session, [telegram_id])
+        principal = Principal(user)
+        session.commit()
+        return principal
+    finally:
+        session.close()
+
+def invalidate_principals(db_sess, telegram_ids=None):
+    """Marks users (None = all) changed for the other processes. Caller commits.
+
+    Once the commit is done the users are dropped from this process's cache and pages
+    listing users (leaderboard) are re-rendered. Doing it before the commit would let a
+    concurrent request cache the old rows again, under the new version.
+    """
+    db.touch_principals(db_sess, telegram_ids)
+
+    def drop_cached(session):
+        if telegram_ids is None:
+            principals.clear()
+        else:
+            for telegram_id in telegram_ids:
+                principals.invalidate(telegram_id)
+        page_cache.bump("users")
+
+    event.listen(db_sess, "after_commit", drop_cached, once=True)
+
+# Rendered page fragments, see render_cached
+page_cache = PageCache(maxsize=getattr(config, "PAGE_CACHE_SIZE", 256))
+
+# Teams per league across all match sources (team_catalog table, kept in memory)
+team_catalog = TeamCatalog()
+TEAM_LIST_LIMIT = getattr(config, "TEAM_LIST_LIMIT", 200)
+
+# Columnar copy of team_matches for /api/predict, rebuilt and swapped when matches are synced
+predictor = PredictionEngine()
+
+async def reload_predictor():
+    global predictor
+    rows, ratings = await asyncio.gather(
+        db.run_sync(db.get_team_match_columns),
+        db.run_sync(db.get_team_ratings)
+    )
+    predictor = await asyncio.to_thread(PredictionEngine, rows, ratings)
+
+def bump_versions(db_sess, *names):
+    """Invalidates cached pages that depend on `names`, here and in the other workers. Caller commits."""
+    db.touch_versions(names, session=db_sess)
+    page_cache.bump(*names)
+
+async def get_current_user(session: str = Cookie(None)):
+    telegram_id = verify_session(session)
+    if telegram_id is None:
+        return None
+    hit, user = principals.get(telegram_id)
+    if hit and user and user.is_banned and user.ban_until and user.ban_until < datetime.now():
+        hit = False # Ban expired, reload (and lift it)
+    if not hit:
+        user = await db.run_sync(load_principal, telegram_id)
+        principals.put(telegram_id, user)
+    return user
+
+async def get_admin(user: Principal = Depends(get_current_user)):
+    if not user or not user.is_admin: raise HTTPException(status_code=403)
+    return user
+
+def set_session_cookie(response, telegram_id):
+    response.set_cookie(key=SESSION_COOKIE, value=sign_session(telegram_id), max_age=SESSION_MAX_AGE, httponly=True, samesite="lax")
+
 def verify_telegram_auth(data: dict, bot_token: str) -> bool:
     """Verifies the hash from Telegram Login Widget"""
     if not data.get('hash'): return False
@@ -57,12 +166,9 @@ app = FastAPI(title="Stataggg Web")
 async def admin_gift_all(
     days: int = Form(...),
     message: str = Form(...),
-    user_id: str = Cookie(None),
+    admin: Principal = Depends(get_admin),
     db_sess: Session = Depends(get_db)
 ):
-    if not user_id: raise HTTPException(status_code=403)
-    admin = db_sess.query(User).filter_by(telegram_id=int(user_id)).first()
-    if not admin or not admin.is_admin: raise HTTPException(status_code=403)
 
     all_users = db_sess.query(User).all()
     now = datetime.now()
@@ -79,18 +185,21 @@ async def admin_gift_all(
         # Set notification
         u.gift_notification = message
     
+    invalidate_principals(db_sess)
     db_sess.commit()
     return {"status": "success", "count": len(all_users)}
 
 @app.post("/api/user/clear_notification")
 async def clear_notification(
-    user_id: str = Cookie(None),
+    principal: Principal = Depends(get_current_user),
     db_sess: Session = Depends(get_db)
 ):
-    if not user_id: return {"status": "error"}
-    user = db_sess.query(User).filter_by(telegram_id=int(user_id)).first()
+    if not principal: return {"status": "error"}
+    if principal.gift_notification is None: return {"status": "success"}
+    user = db_sess.query(User).filter_by(telegram_id=principal.telegram_id).first()
     if user:
         user.gift_notification = None
+        invalidate_principals(db_sess, [user.telegram_id])
         db_sess.commit()
     return {"status": "success"}
 
@@ -100,97 +209,96 @@ async def log_requests(request: Request, call_next):
     response = await call_next(request)
     return response
 
-# --- WEBSOCKET MANAGER ---
+@app.middleware("http")
+async def track_reader(request: Request, call_next):
+    """Read-your-writes on replicas: after a user's write their reads stay on the primary.
 
-class ConnectionManager:
-    def __init__(self):
-        # Map websocket to user data: {websocket: {"id": 1, "username": "Admin", "photo": "..."}}
-        self.active_connections: dict = {}
-
-    async def connect(self, websocket: WebSocket, user_data: dict = None):
-        await websocket.accept()
-        self.active_connections[websocket] = user_data
-        if user_data:
-            await self.broadcast_online_list()
-
-    async def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            del self.active_connections[websocket]
-            await self.broadcast_online_list()
-
-    async def broadcast(self, message: dict):
-        for connection in list(self.active_connections.keys()):
-            try:
-                await connection.send_json(message)
-            except:
-                if connection in self.active_connections:
-                    del self.active_connections[connection]
-
-    async def broadcast_online_list(self):
-        # Get unique users
-        unique_users = {}
-        for data in self.active_connections.values():
-            if data and data.get("id"):
-                unique_users[data["id"]] = data
-        
-        online_list = list(unique_users.values())
-        await self.broadcast({
-            "type": "online_list",
-            "users": online_list
-        })
+    The deadline travels in a short-lived signed cookie, so it holds whichever worker
+    serves the next request (see database.ReadState).
+    """
+    state = ReadState(verify_primary_until(request.cookies.get(PRIMARY_COOKIE)))
+    token = current_reader.set(state)
+    try:
+        response = await call_next(request)
+    finally:
+        current_reader.reset(token)
+    if state.wrote:
+        response.set_cookie(
+            key=PRIMARY_COOKIE, value=sign_primary_until(state.primary_until),
+            max_age=math.ceil(db.sticky_seconds), httponly=True, samesite="lax"
+        )
+    return response
+
+# --- WEBSOCKET MANAGER ---
 
-manager = ConnectionManager()
+manager = ConnectionManager(
+    max_queue=getattr(config, "CHAT_QUEUE_SIZE", 256),
+    send_timeout=getattr(config, "CHAT_SEND_TIMEOUT", 10),
+    backend=create_pubsub(getattr(config, "CHAT_PUBSUB_URL", "")),
+    presence_window=getattr(config, "CHAT_PRESENCE_WINDOW", 1.0)
+)
 
 # --- CHAT ROUTES ---
 
+chat_history = ChatHistory(size=getattr(config, "CHAT_HISTORY_SIZE", 100))
+manager.listeners.append(chat_history.apply)
+
+async def warm_chat_history():
+    """Loads the last messages into the ring buffer (startup)."""
+    async with db.get_async_session() as db_sess:
+        result = await db_sess.execute(
+            select(ChatMessage)
+            .options(selectinload(ChatMessage.user)) # Lazy loads are not allowed on AsyncSession
+            .order_by(ChatMessage.id.desc())
+            .limit(chat_history.messages.maxlen)
+        )
+        messages = result.scalars().all()
+    # Oldest first for UI
+    chat_history.load(message_payload(m) for m in reversed(messages))
+
 @app.get("/api/chat/history")
-async def get_chat_history(db_sess: Session = Depends(get_db)):
-    """Fetch last 100 messages"""
-    messages = db_sess.query(ChatMessage).order_by(ChatMessage.created_at.desc()).limit(100).all()
-    # Return reversed (oldest first) for UI
-    return [{
-        "id": m.id,
-        "content": m.content,
-        "username": m.user.username or m.user.first_name,
-        "is_admin": m.user.is_admin,
-        "is_premium": m.user.is_premium,
-        "photo_url": m.user.photo_url,
-        "created_at": m.created_at.strftime("%H:%M"),
-        "timestamp": m.created_at.timestamp(),
-        "reply_to": m.reply_to_id,
-        "is_edited": m.is_edited
-    } for m in reversed(messages)]
+async def get_chat_history(request: Request):
+    """Last messages from the ring buffer, pre-serialized, 304 if the client's copy is current"""
+    body, etag = chat_history.render()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def publish_message_ids(ids: dict):
+    """Tells clients the DB ids of messages that were broadcast with provisional ids."""
+    await manager.broadcast({"type": "message_ids", "ids": {str(k): v for k, v in ids.items()}})
+
+async def retract_messages(provisional_ids: list):
+    """Takes back messages that were broadcast but could not be saved."""
+    for msg_id in provisional_ids:
+        await manager.broadcast({"type": "delete", "id": msg_id})
+
+@app.get("/api/chat/presence")
+async def get_chat_presence():
+    """Versioned online list. Clients refetch it only when they miss a presence delta."""
+    return Response(content=await manager.presence_snapshot(), media_type="application/json")
 
 @app.websocket("/ws/chat")
-async def websocket_chat_endpoint(websocket: WebSocket, db_sess: Session = Depends(get_db)):
-    # Parse User from Cookie at the start
-    cookie_header = websocket.headers.get('cookie')
+async def websocket_chat_endpoint(websocket: WebSocket):
+    # Resolve the user from the session cookie at the start (principal cache, usually no DB hit)
+    user = await get_current_user(websocket.cookies.get(SESSION_COOKIE))
     user_data = None
-    user_id = None
-    if cookie_header:
-        from http.cookies import SimpleCookie
-        cookie = SimpleCookie()
-        cookie.load(cookie_header)
-        if 'user_id' in cookie:
-            user_id = cookie['user_id'].value
-    
-    if user_id:
-        user = db_sess.query(User).filter_by(telegram_id=int(user_id)).first()
-        if user and not user.is_banned:
-            user_data = {
-                "id": user.telegram_id,
-                "username": user.username or user.first_name,
-                "photo_url": user.photo_url,
-                "is_admin": user.is_admin,
-                "is_premium": user.is_premium
-            }
+    if user and not user.is_banned:
+        user_data = {
+            "id": user.telegram_id,
+            "username": user.username or user.first_name,
+            "photo_url": user.photo_url,
+            "is_admin": user.is_admin,
+            "is_premium": user.is_premium
+        }
 
     await manager.connect(websocket, user_data)
     
     try:
         while True:
             data = await websocket.receive_json()
-            if not user_id or not user_data: continue
+            if not user_data: continue
             
             # Re-fetch user in loop only if needed (e.g. for ban check)
             # but for performance let's use cached user_data for now
@@ -201,44 +309,45 @@ async def websocket_chat_endpoint(websocket: WebSocket, db_sess: Session = Depen
                 if not content: continue
                 
                 reply_to_id = data.get('reply_to_id')
+                if not isinstance(reply_to_id, int): reply_to_id = None
                 
-                # Save to DB
-                new_msg = ChatMessage(
-                    user_id=user.id,
-                    content=content,
-                    reply_to_id=reply_to_id
-                )
-                db_sess.add(new_msg)
-                db_sess.commit()
-                
-                # Cleanup Old Messages (>100)
-                count = db_sess.query(ChatMessage).count()
-                if count > 100:
-                    limit_count = count - 100
-                    subq = db_sess.query(ChatMessage.id).order_by(ChatMessage.created_at.asc()).limit(limit_count)
-                    db_sess.query(ChatMessage).filter(ChatMessage.id.in_(subq)).delete(synchronize_session=False)
-                    db_sess.commit()
-
-                # Broadcast
+                # Broadcast first with a provisional id, the write-behind buffer saves it
+                msg_id = chat_writer.provisional_id()
+                created_at = datetime.now()
                 await manager.broadcast({
                     "type": "new_message",
-                    "id": new_msg.id,
-                    "content": new_msg.content,
+                    "id": msg_id,
+                    "content": content,
                     "username": user_data["username"],
                     "is_admin": user_data["is_admin"],
                     "is_premium": user_data["is_premium"],
                     "photo_url": user_data["photo_url"],
-                    "created_at": new_msg.created_at.strftime("%H:%M"),
-                    "reply_to": reply_to_id
+                    "created_at": created_at.strftime("%H:%M"),
+                    "timestamp": created_at.timestamp(),
+                    "reply_to": reply_to_id,
+                    "is_edited": False
+                })
+                chat_writer.add({
+                    "provisional_id": msg_id,
+                    "user_id": user.id,
+                    "content": content,
+                    "reply_to_id": reply_to_id,
+                    "created_at": created_at
                 })
                 
             elif data['type'] == 'delete' and user_data["is_admin"]:
                 msg_id = data.get('msg_id')
-                msg = db_sess.query(ChatMessage).filter_by(id=msg_id).first()
-                if msg:
-                     db_sess.delete(msg)
-                     db_sess.commit()
-                     await manager.broadcast({"type": "delete", "id": msg_id})
+                if not isinstance(msg_id, int): continue
+                db_id = await chat_writer.discard(msg_id)
+                if db_id:
+                    async with db.get_async_session() as db_sess:
+                        msg = await db_sess.get(ChatMessage, db_id)
+                        if msg:
+                            await db_sess.delete(msg)
+                            await db_sess.commit()
+                await manager.broadcast({"type": "delete", "id": msg_id})
+                if db_id and db_id != msg_id:
+                    await manager.broadcast({"type": "delete", "id": db_id})
 
     except WebSocketDisconnect:
         await manager.disconnect(websocket)
@@ -250,6 +359,14 @@ async def websocket_chat_endpoint(websocket: WebSocket, db_sess: Session = Depen
 
 db = Database()
 print(f"Database Connected: {db.url}")
+
+chat_writer = ChatWriter(
+    db,
+    on_commit=publish_message_ids,
+    on_drop=retract_messages,
+    flush_interval=getattr(config, "CHAT_FLUSH_INTERVAL_MS", 20) / 1000,
+    batch_size=getattr(config, "CHAT_FLUSH_BATCH", 50)
+)
 print("DEBUG: Routes /disciplines/add registered.")
 
 BASE_DIR = Path(__file__).resolve().parent
@@ -283,27 +400,35 @@ def verify_telegram_auth(data: dict, bot_token: str) -> bool:
     
     return hash_calc == check_hash
 
-def get_current_user(request: Request, user_id: str = Cookie(None), db_sess: Session = Depends(get_db)):
-    if not user_id:
-        return None
-    try:
-        user = db_sess.query(User).filter_by(telegram_id=int(user_id)).first()
-        if user and user.is_banned:
-            if user.ban_until and user.ban_until < datetime.now():
-                user.is_banned = False
-                user.ban_until = None
-                db_sess.commit()
-            else:
-                # User is still banned
-                return user
-        return user
-    except:
-        return None
+async def render_cached(request: Request, user, template_name: str, deps, load, key=None):
+    """Renders a page whose `content` block is shared by all users with the same role.
+
+    The block is cached per (template, key, versions of `deps`, role); `load()` returns
+    its template variables and only runs on a miss (DB work goes through db.run_sync, off
+    the event loop). The per-user shell from base.html
+    is rendered around it on every 200. Repeat visits get a 304 via ETag/Last-Modified.
+    A page rendered while some source was down (`degraded` in the context) is not cached.
+    """
+    cache_key = page_cache.key(template_name, key, deps, user_role(user))
+    fragment = page_cache.get(cache_key)
+    if fragment is None:
+        context = await load()
+        template = templates.get_template(template_name)
+        block = template.blocks["content"](template.new_context({"request": request, "user": user, **context}))
+        fragment = Fragment("".join(block))
+        if not context.get("degraded"):
+            page_cache.put(cache_key, fragment)
+
+    etag = f'"{fragment.etag}-{user_fingerprint(user)}"'
+    headers = {"ETag": etag, "Last-Modified": http_date(fragment.last_modified), "Cache-Control": "private, no-cache"}
+    if not_modified(request, etag, fragment.last_modified):
+        return Response(status_code=304, headers=headers)
+    return templates.TemplateResponse("cached_page.html", {"request": request, "user": user, "content": fragment.html}, headers=headers)
 
 # --- ROUTES ---
 
 @app.get("/", response_class=HTMLResponse)
-async def home(request: Request, user: User = Depends(get_current_user)):
+async def home(request: Request, user: Principal = Depends(get_current_user)):
     if user and user.is_banned:
         return templates.TemplateResponse("banned.html", {"request": request, "user_obj": user, "user": user}, status_code=403)
     
@@ -343,6 +468,8 @@ async def auth_telegram(
             is_admin=(tg_id in config.ADMIN_IDS)
         )
         db_sess.add(user)
+        # The id may be cached as unknown (e.g. deleted by an admin while its cookie stayed valid)
+        invalidate_principals(db_sess, [tg_id])
         db_sess.commit()
         logger.info(f"New User Registered: {username} ({tg_id})")
     else:
@@ -353,11 +480,12 @@ async def auth_telegram(
         user.photo_url = photo_url
         if tg_id in config.ADMIN_IDS:
             user.is_admin = True
+        invalidate_principals(db_sess, [tg_id])
         db_sess.commit()
 
-    # Login (Set Cookie)
+    # Login (Set signed session cookie)
     response = RedirectResponse(url="/dashboard")
-    response.set_cookie(key="user_id", value=str(tg_id)) # Simple cookie for now
+    set_session_cookie(response, tg_id)
     return response
 
 @app.get("/auth/dev")
@@ -374,104 +502,239 @@ async def auth_dev(db_sess: Session = Depends(get_db)):
             is_admin=True
         )
         db_sess.add(user)
+        invalidate_principals(db_sess, [dev_id])
         db_sess.commit()
     else:
         # Ensure dev is always admin
         if not user.is_admin:
             user.is_admin = True
+            invalidate_principals(db_sess, [dev_id])
             db_sess.commit()
     
     response = RedirectResponse(url="/dashboard")
-    response.set_cookie(key="user_id", value=str(dev_id))
+    set_session_cookie(response, dev_id)
     return response
 
 
 
 @app.get("/reset_premium")
-async def reset_premium_dev(request: Request, user_id: str = Cookie(None), db_sess: Session = Depends(get_db)):
+async def reset_premium_dev(request: Request, principal: Principal = Depends(get_current_user), db_sess: Session = Depends(get_db)):
     """Temporary Dev Route to Reset to Basic"""
-    if not user_id: return RedirectResponse(url="/")
-    user = db_sess.query(User).filter_by(telegram_id=int(user_id)).first()
+    if not principal: return RedirectResponse(url="/")
+    user = db_sess.query(User).filter_by(telegram_id=principal.telegram_id).first()
     if not user: return RedirectResponse(url="/")
     
     # Reset to Basic
     user.is_premium = False
     user.premium_since = None
     user.premium_until = None
+    invalidate_principals(db_sess, [user.telegram_id])
     db_sess.commit()
     
     return RedirectResponse(url="/dashboard", status_code=302)
 
 @app.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request, user: User = Depends(get_current_user)):
+async def dashboard(request: Request, user: Principal = Depends(get_current_user)):
     if not user: return RedirectResponse(url="/")
     if user and user.is_banned:
         return templates.TemplateResponse("banned.html", {"request": request, "user_obj": user, "user": user}, status_code=403)
         
-    # Fetch Matches (Aggregated from CS2 & Dota)
-    finished_matches = db.get_finished_matches_paginated(limit=10)
-
-    return templates.TemplateResponse("dashboard.html", {
-        "request": request, 
-        "user": user,
-        "live_matches": [],
-        "upcoming_matches": [],
-        "finished_matches": finished_matches
-    })
+    async def load():
+        # Fetch Matches (Aggregated from CS2 & Dota)
+        finished_matches = await db.run_sync(db.get_finished_matches_paginated, limit=10)
+        return {
+            "live_matches": [],
+            "upcoming_matches": [],
+            "finished_matches": finished_matches,
+            "degraded": sorted(finished_matches.degraded)
+        }
 
-@app.get("/api/matches")
+    return await render_cached(request, user, "dashboard.html", ("matches",), load)
+
+# --- MATCHES API (v1) ---
+
+# Item field -> FeedMatch field. Maps are parsed integers from match_maps.
+MATCH_FIELDS = {
+    "id": "id",
+    "game_type": "source",
+    "league": "league_name", # Branded league name of the source
+    "match_time": "match_time",
+    "match_ts": "match_ts",
+    "team1": "team1",
+    "team2": "team2",
+    "score": "score",
+    "s1": "s1",
+    "s2": "s2",
+    "odds_p1": "odds_p1",
+    "odds_p2": "odds_p2",
+    "maps": "maps",
+    "cursor": "cursor",
+}
+# Without `fields=`: the payload /api/matches always had
+DEFAULT_MATCH_FIELDS = ("id", "match_time", "league", "team1", "team2", "score", "s1", "s2", "odds_p1", "odds_p2", "maps", "cursor")
+
+match_mappers = {} # field tuple -> compiled FeedMatch -> dict mapper
+
+def match_fields(fields: str):
+    """Validated field tuple of a `fields=a,b,c` projection."""
+    if not fields: return DEFAULT_MATCH_FIELDS
+    names = tuple(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    unknown = [name for name in names if name not in MATCH_FIELDS]
+    if unknown or not names:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(MATCH_FIELDS)}")
+    return names
+
+def match_mapper(names):
+    mapper = match_mappers.get(names)
+    if mapper is None:
+        mapper = match_mappers[names] = compile_mapper(FeedMatch._fields, {name: MATCH_FIELDS[name] for name in names})
+    return mapper
+
+async def matches_page(request: Request, names, skip, limit, cursor):
+    """Serialized feed page, shared by every user asking for the same (skip, limit, cursor, fields).
+
+    Cached until the "matches" version changes (new matches synced); clients
+    revalidate with ETag. Map scores are only loaded when "maps" is projected.
+    A page missing some source is served uncached, listing it in X-Degraded-Sources.
+    """
+    cache_key = page_cache.key("api/v1/matches", (skip, limit, cursor, names), ("matches",), None)
+    payload = page_cache.get(cache_key)
+    degraded = ()
+    if payload is None:
+        matches = await db.run_sync(
+            db.get_finished_matches_paginated, skip=skip, limit=limit, cursor=cursor, with_maps="maps" in names
+        )
+        mapper = match_mapper(names)
+        payload = Payload(dumps([mapper(m) for m in matches]))
+        degraded = sorted(matches.degraded)
+        if not degraded:
+            page_cache.put(cache_key, payload)
+
+    etag = f'"{payload.etag}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if degraded:
+        headers["X-Degraded-Sources"] = ",".join(degraded)
+    if not_modified(request, etag, payload.last_modified):
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse(payload.body, headers=headers)
+
+# `skip` loads skip+limit rows from every source: deep pages must use `cursor`
+MATCH_FEED_MAX_SKIP = 1000
+
+@app.get("/api/v1/matches")
+@app.get("/api/matches") # Unversioned alias for old clients, same v1 payload
 async def get_matches_api(
-    skip: int = 0,
-    limit: int = 10
+    request: Request,
+    skip: int = Query(0, ge=0, le=MATCH_FEED_MAX_SKIP),
+    limit: int = Query(10, ge=1, le=100),
+    cursor: str = None,
+    fields: str = Query(None)
 ):
     """
-    Pagination endpoint for matches history. Uses aggregate logic from Database class.
+    Finished matches of all sources, newest first. Pass the `cursor` of the last received
+    match to get the next page, and `fields=id,team1,...` to receive only those fields.
+    `skip` (old clients) is limited to MATCH_FEED_MAX_SKIP and ignored with a cursor.
     """
-    matches = db.get_finished_matches_paginated(skip=skip, limit=limit)
-        
-    result = []
-    for m in matches:
-        # Determine scores for coloring (frontend expect integers)
-        s1, s2 = 0, 0
-        if m.score and ':' in str(m.score):
-            try:
-                parts = str(m.score).split(':')
-                s1 = int(parts[0])
-                s2 = int(parts[1])
-            except: pass
-            
-        # Use the branded league name if available, fallback to game_type
-        league_name = getattr(m, 'league_name', m.game_type)
-            
-        result.append({
-            "id": m.id,
-            "match_time": m.match_time,
-            "league": league_name,
-            "team1": m.team1,
-            "team2": m.team2,
-            "score": m.score,
-            "s1": s1, 
-            "s2": s2,
-            "odds_p1": m.odds_p1,
-            "odds_p2": m.odds_p2,
-            "map_scores": m.map_scores,
-            "history": m.history 
-        })
-        
-    return result
+    if cursor: skip = 0 # Same page either way: keeps one cache entry per cursor
+    return await matches_page(request, match_fields(fields), skip, limit, cursor)
+
+EXPORT_FIELDS = ("id", "game_type", "league", "match_time", "match_ts", "team1", "team2", "score", "s1", "s2",
+                 "odds_p1", "odds_p2", "winner", "maps", "updated_at")
+
+def export_row(m):
+    return {
+        "id": m.id,
+        "game_type": m.source,
+        "league": m.league_name,
+        "match_time": m.match_time,
+        "match_ts": m.match_ts.isoformat() if m.match_ts else None,
+        "team1": m.team1,
+        "team2": m.team2,
+        "score": m.score,
+        "s1": m.s1,
+        "s2": m.s2,
+        "odds_p1": m.odds_p1,
+        "odds_p2": m.odds_p2,
+        "winner": m.winner,
+        "maps": [[mp.map_no, mp.s1, mp.s2] for _, mp in sorted(m.maps.items())],
+        "updated_at": m.updated_at.isoformat() if m.updated_at else None
+    }
+
+EXPORT_CHUNK = 64 * 1024 # Bytes buffered before a chunk is sent
+
+def parse_export_since(value: str):
+    """`since` of the export: "CS2=<iso datetime>,DOTA2=<iso datetime>" or one ISO datetime."""
+    if not value: return None
+    try:
+        if "=" not in value: return datetime.fromisoformat(value)
+        pairs = (part.split("=", 1) for part in value.split(",") if part.strip())
+        return {game_type.strip(): datetime.fromisoformat(ts.strip()) for game_type, ts in pairs}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="since: GAME_TYPE=<ISO datetime> pairs separated by commas")
+
+@app.get("/api/matches/export")
+async def export_matches(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    since: str = Query(None),
+    game_type: str = Query(None)
+):
+    """Full finished-match history of all sources as NDJSON (one match per line) or CSV.
+
+    Streamed straight from server-side cursors. For incremental syncs keep the largest
+    `updated_at` received per `game_type` and pass them all as `since=CS2=...,DOTA2=...`
+    (a single datetime is only safe together with `game_type`). Matches near a watermark
+    are sent again, so upsert by `id`.
+    """
+    matches = db.iter_finished_matches(game_type=game_type or None, since=parse_export_since(since))
+
+    def ndjson():
+        buf = []
+        size = 0
+        for m in matches:
+            line = json.dumps(export_row(m), ensure_ascii=False) + "\n"
+            buf.append(line)
+            size += len(line)
+            if size >= EXPORT_CHUNK:
+                yield "".join(buf)
+                buf, size = [], 0
+        yield "".join(buf)
+
+    def csv_rows():
+        out = io.StringIO()
+        writer = csv.DictWriter(out, EXPORT_FIELDS)
+        writer.writeheader()
+        for m in matches:
+            row = export_row(m)
+            row["maps"] = " ".join(f"{s1}:{s2}" for _, s1, s2 in row["maps"])
+            writer.writerow(row)
+            if out.tell() >= EXPORT_CHUNK:
+                yield out.getvalue()
+                out.seek(0)
+                out.truncate()
+        yield out.getvalue()
+
+    # Sync generators: Starlette iterates them in its thread pool, off the event loop
+    if format == "csv":
+        return StreamingResponse(csv_rows(), media_type="text/csv",
+                                 headers={"Content-Disposition": 'attachment; filename="matches.csv"'})
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
 
 @app.get("/streams", response_class=HTMLResponse)
-async def streams_page(request: Request, user: User = Depends(get_current_user), db_sess: Session = Depends(get_db)):
+async def streams_page(request: Request, user: Principal = Depends(get_current_user)):
     if not user: return RedirectResponse(url="/")
     if user and user.is_banned:
         return templates.TemplateResponse("banned.html", {"request": request, "user_obj": user, "user": user}, status_code=403)
 
-    disciplines = db_sess.query(Discipline).filter_by(is_active=True).all()
-    return templates.TemplateResponse("streams.html", {
-        "request": request, 
-        "user": user, 
-        "disciplines": disciplines
-    })
+    def fetch():
+        db_sess = db.get_session()
+        try:
+            return {"disciplines": db_sess.query(Discipline).filter_by(is_active=True).all()}
+        finally: db_sess.close()
+
+    async def load():
+        return await db.run_sync(fetch)
+
+    return await render_cached(request, user, "streams.html", ("disciplines",), load)
 
 @app.get("/profile", response_class=HTMLResponse)
 async def profile_page(request: Request):
@@ -479,19 +742,117 @@ async def profile_page(request: Request):
     return RedirectResponse(url="/dashboard")
 
 @app.get("/leaderboard", response_class=HTMLResponse)
-async def leaderboard_page(request: Request, user: User = Depends(get_current_user), db_sess: Session = Depends(get_db)):
+async def leaderboard_page(request: Request, user: Principal = Depends(get_current_user)):
     if not user: return RedirectResponse(url="/")
     if user and user.is_banned:
         return templates.TemplateResponse("banned.html", {"request": request, "user_obj": user, "user": user}, status_code=403)
 
-    # Top 50 users by registration date
-    top_users = db_sess.query(User).order_by(User.created_at.desc()).limit(50).all()
+    def fetch():
+        db_sess = db.get_session()
+        try:
+            # Top 50 users by registration date
+            return {"users": db_sess.query(User).order_by(User.created_at.desc()).limit(50).all()}
+        finally: db_sess.close()
 
-    return templates.TemplateResponse("leaderboard.html", {
-        "request": request, 
-        "user": user, 
-        "users": top_users
-    })
+    async def load():
+        return await db.run_sync(fetch)
+
+    return await render_cached(request, user, "leaderboard.html", ("users",), load)
+
+# --- BACKGROUND JOBS ---
+
+MATCH_SYNC_INTERVAL = getattr(config, "MATCH_SYNC_INTERVAL", 30)
+
+async def match_sync_loop():
+    """Follows the bot DBs and indexes matches as they become FINISHED.
+
+    With several workers only the holder of the 'match_sync' lease does the work.
+    Matches the bots inserted get their match_ts first, so the feed order stays right.
+    New results are fed to the team ratings, and the stored predictions of UPCOMING
+    matches are kept current: all of them on its first run or after a rating replay,
+    then new matches and those of teams that just played.
+    """
+    rescore_all = True
+    while True:
+        try:
+            if not await db.run_sync(db.try_acquire_lease, "match_sync", WORKER_ID, MATCH_SYNC_INTERVAL * 3):
+                await asyncio.sleep(MATCH_SYNC_INTERVAL)
+                continue
+            converted = await db.run_sync(db.convert_match_maps)
+            if converted:
+                logger.info(f"Match sync: converted map scores of {converted} matches")
+            filled = await db.run_sync(db.backfill_sources_match_ts)
+            if filled:
+                logger.info(f"Match sync: filled match_ts of {filled} matches")
+            added, changed = await db.run_sync(db.sync_team_matches)
+            rated = await db.run_sync(db.sync_ratings, added, changed)
+            if added:
+                logger.info(f"Match sync: indexed {len(added)} team rows")
+                team_catalog.add((row.game_type, row.team) for row in added)
+            if changed:
+                logger.info(f"Match sync: {len(changed)} team rows corrected")
+            if rated:
+                logger.info(f"Match sync: ratings updated {rated}")
+            if filled or added or changed or rated:
+                await reload_predictor()
+                page_cache.bump("matches")
+                await db.run_sync(db.touch_versions, ["matches"])
+            rescore_all = rescore_all or "replay" in rated.values()
+            teams = None if rescore_all else {row.team for row in added + changed}
+            stored = await db.run_sync(db.sync_predictions, predictor.predict_many, teams)
+            rescore_all = False
+            if stored:
+                logger.info(f"Match sync: stored {stored} predictions")
+        except Exception as e:
+            logger.error(f"Match sync error: {e}")
+        await asyncio.sleep(MATCH_SYNC_INTERVAL)
+
+CHAT_HISTORY_SIZE = getattr(config, "CHAT_HISTORY_SIZE", 100)
+CHAT_RETENTION_INTERVAL = getattr(config, "CHAT_RETENTION_INTERVAL", 60)
+
+async def chat_retention_loop():
+    """Trims chat_messages to the newest CHAT_HISTORY_SIZE rows (replaces the per-message cleanup)."""
+    while True:
+        try:
+            if await db.run_sync(db.try_acquire_lease, "chat_retention", WORKER_ID, CHAT_RETENTION_INTERVAL * 3):
+                deleted = await db.run_sync(db.trim_chat_messages, CHAT_HISTORY_SIZE)
+                if deleted:
+                    logger.info(f"Chat retention: deleted {deleted} old messages")
+        except Exception as e:
+            logger.error(f"Chat retention error: {e}")
+        await asyncio.sleep(CHAT_RETENTION_INTERVAL)
+
+PRINCIPAL_POLL_INTERVAL = getattr(config, "PRINCIPAL_POLL_INTERVAL", 2)
+
+async def change_poll_loop():
+    """Drops cached users and pages changed by other processes (payment bot, other web workers)."""
+    since = datetime.now()
+    seen = {} # key -> updated_at already handled (polls overlap)
+    while True:
+        await asyncio.sleep(PRINCIPAL_POLL_INTERVAL)
+        try:
+            markers, since = await db.run_sync(db.changed_markers, since)
+            seen = {key: ts for key, ts in seen.items() if ts >= since}
+            versions = set()
+            for key, updated_at in markers:
+                if seen.get(key) == updated_at: continue
+                seen[key] = updated_at
+                kind, name = key.split(":", 1)
+                if kind == "version":
+                    versions.add(name)
+                elif name == "*":
+                    principals.clear()
+                    versions.add("users")
+                else:
+                    principals.invalidate(int(name))
+                    versions.add("users")
+            page_cache.bump(*versions)
+            if "matches" in versions:
+                # Synced by another worker
+                team_catalog.load(await db.run_sync(db.get_team_catalog))
+                await reload_predictor()
+        except Exception as e:
+            logger.error(f"Change poll error: {e}")
 
 @app.on_event("startup")
 async def startup_event():
@@ -500,6 +861,24 @@ async def startup_event():
         methods = getattr(route, "methods", "N/A")
         logger.info(f"Route: {route.path} [{methods}]")
 
+    await manager.start()
+    await warm_chat_history()
+    team_catalog.load(await db.run_sync(db.get_team_catalog))
+    await reload_predictor()
+    chat_writer.start()
+    app.state.match_sync_task = asyncio.create_task(match_sync_loop())
+    app.state.chat_retention_task = asyncio.create_task(chat_retention_loop())
+    app.state.change_poll_task = asyncio.create_task(change_poll_loop())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.match_sync_task.cancel()
+    app.state.chat_retention_task.cancel()
+    app.state.change_poll_task.cancel()
+    await chat_writer.close() # Flush queued messages before the DB goes away
+    await manager.close()
+    await db.close()
+
 @app.get("/disciplines/add")
 async def add_discipline_get():
     return {"message": "GET request received. POST to this URL to add a discipline."}
@@ -515,12 +894,9 @@ from fastapi import File, UploadFile
 async def add_discipline(
     name: str = Form(...),
     image: UploadFile = File(...),
-    user_id: str = Cookie(None),
+    admin: Principal = Depends(get_admin),
     db_sess: Session = Depends(get_db)
 ):
-    if not user_id: raise HTTPException(status_code=403)
-    user = db_sess.query(User).filter_by(telegram_id=int(user_id)).first()
-    if not user or not user.is_admin: raise HTTPException(status_code=403)
 
     # Validate file type
     if not image.content_type.startswith("image/"):
@@ -539,40 +915,41 @@ async def add_discipline(
 
     new_disc = Discipline(name=name, image_url=image_url)
     db_sess.add(new_disc)
+    bump_versions(db_sess, "disciplines")
     db_sess.commit()
     
     return RedirectResponse(url="/streams", status_code=303)
 
 @app.get("/streams/{discipline_id}", response_class=HTMLResponse)
-async def discipline_page(discipline_id: int, request: Request, user: User = Depends(get_current_user), db_sess: Session = Depends(get_db)):
+async def discipline_page(discipline_id: int, request: Request, user: Principal = Depends(get_current_user)):
     if not user: return RedirectResponse(url="/")
     if user and user.is_banned:
         return templates.TemplateResponse("banned.html", {"request": request, "user_obj": user, "user": user}, status_code=403)
 
-    discipline = db_sess.query(Discipline).filter_by(id=discipline_id).first()
-    if not discipline:
-        raise HTTPException(status_code=404, detail="Discipline not found")
+    def fetch():
+        db_sess = db.get_session()
+        try:
+            discipline = db_sess.query(Discipline).filter_by(id=discipline_id).first()
+            if not discipline:
+                raise HTTPException(status_code=404, detail="Discipline not found")
 
-    channels = db_sess.query(StreamChannel).filter_by(discipline_id=discipline_id, is_active=True).all()
+            channels = db_sess.query(StreamChannel).filter_by(discipline_id=discipline_id, is_active=True).all()
+            return {"discipline": discipline, "channels": channels}
+        finally: db_sess.close()
 
-    return templates.TemplateResponse("discipline.html", {
-        "request": request, 
-        "user": user, 
-        "discipline": discipline,
-        "channels": channels
-    })
+    async def load():
+        return await db.run_sync(fetch)
+
+    return await render_cached(request, user, "discipline.html", ("disciplines", "channels"), load, key=discipline_id)
 
 @app.post("/streams/{discipline_id}/add_channel")
 async def add_channel(
     discipline_id: int,
     name: str = Form(...),
     stream_url: str = Form(...),
-    user_id: str = Cookie(None),
+    admin: Principal = Depends(get_admin),
     db_sess: Session = Depends(get_db)
 ):
-    if not user_id: raise HTTPException(status_code=403)
-    user = db_sess.query(User).filter_by(telegram_id=int(user_id)).first()
-    if not user or not user.is_admin: raise HTTPException(status_code=403)
 
     new_channel = StreamChannel(
         discipline_id=discipline_id,
@@ -580,6 +957,7 @@ async def add_channel(
         stream_url=stream_url
     )
     db_sess.add(new_channel)
+    bump_versions(db_sess, "channels")
     db_sess.commit()
     
     return RedirectResponse(url=f"/streams/{discipline_id}", status_code=303)
@@ -588,16 +966,14 @@ async def add_channel(
 async def delete_channel(
     discipline_id: int, 
     channel_id: int, 
-    user_id: str = Cookie(None), 
+    admin: Principal = Depends(get_admin),
     db_sess: Session = Depends(get_db)
 ):
-    if not user_id: raise HTTPException(status_code=403)
-    user = db_sess.query(User).filter_by(telegram_id=int(user_id)).first()
-    if not user or not user.is_admin: raise HTTPException(status_code=403)
 
     channel = db_sess.query(StreamChannel).filter_by(id=channel_id, discipline_id=discipline_id).first()
     if channel:
         db_sess.delete(channel)
+        bump_versions(db_sess, "channels")
         db_sess.commit()
     
     return RedirectResponse(url=f"/streams/{discipline_id}", status_code=303)
@@ -605,12 +981,9 @@ async def delete_channel(
 @app.post("/disciplines/{discipline_id}/delete")
 async def delete_discipline(
     discipline_id: int, 
-    user_id: str = Cookie(None), 
+    admin: Principal = Depends(get_admin),
     db_sess: Session = Depends(get_db)
 ):
-    if not user_id: raise HTTPException(status_code=403)
-    user = db_sess.query(User).filter_by(telegram_id=int(user_id)).first()
-    if not user or not user.is_admin: raise HTTPException(status_code=403)
 
     disc = db_sess.query(Discipline).filter_by(id=discipline_id).first()
     if disc:
@@ -618,6 +991,7 @@ async def delete_discipline(
         # Optional: Delete associated channels? SQLAlchemy cascade might handle it or we leave orphans.
         # For now, just delete the record.
         db_sess.delete(disc)
+        bump_versions(db_sess, "disciplines")
         db_sess.commit()
     
     return RedirectResponse(url="/streams", status_code=303)
@@ -625,38 +999,81 @@ async def delete_discipline(
 @app.get("/logout")
 async def logout():
     response = RedirectResponse(url="/")
-    response.delete_cookie("user_id")
+    response.delete_cookie(SESSION_COOKIE)
+    response.delete_cookie("user_id") # Pre-token cookie
     return response
 
 # --- ADMIN PANEL ---
 
 @app.get("/admin", response_class=HTMLResponse)
-async def admin_page(request: Request, user: User = Depends(get_current_user), db_sess: Session = Depends(get_db)):
+async def admin_page(request: Request, user: Principal = Depends(get_current_user), db_sess: AsyncSession = Depends(get_async_read_db)):
     if not user: return RedirectResponse(url="/")
     if user and user.is_banned:
         return templates.TemplateResponse("banned.html", {"request": request, "user_obj": user, "user": user}, status_code=403)
     if not user.is_admin:
         raise HTTPException(status_code=403, detail="Доступ запрещен")
 
-    all_users = db_sess.query(User).order_by(User.created_at.desc()).all()
-    
+    # Rows are loaded page by page from /api/admin/users while the table is scrolled
+    total_users = (await db_sess.execute(select(func.count(User.id)))).scalar()
+
     return templates.TemplateResponse("admin.html", {
         "request": request,
         "user": user,
-        "users": all_users
+        "total_users": total_users
     })
 
+def admin_user_row(u):
+    return {
+        "telegram_id": u.telegram_id,
+        "username": u.username,
+        "first_name": u.first_name,
+        "photo_url": u.photo_url,
+        "is_admin": bool(u.is_admin),
+        "is_banned": bool(u.is_banned),
+        "ban_until": u.ban_until.isoformat() if u.ban_until else None,
+        "is_premium": bool(u.is_premium),
+        "premium_until": u.premium_until.isoformat() if u.premium_until else None,
+        "created_at": u.created_at.isoformat() if u.created_at else None,
+    }
+
+@app.get("/api/admin/users")
+async def admin_users(
+    cursor: str = None,
+    limit: int = Query(50, ge=1, le=200),
+    is_premium: bool = Query(None, alias="premium"),
+    is_banned: bool = Query(None, alias="banned"),
+    is_admin: bool = Query(None, alias="admin"),
+    q: str = Query(None, max_length=100),
+    admin: Principal = Depends(get_admin)
+):
+    """
+    Users newest first, `limit` per page. Pass `next_cursor` as `cursor` for the next page
+    (null = last page). Filters: premium / banned / admin = true|false, `q` = prefix of the
+    username or telegram_id.
+    """
+    users, next_cursor = await db.run_sync(
+        db.get_users_page, cursor=cursor, limit=limit, premium=is_premium, banned=is_banned, admin=is_admin, q=q
+    )
+    return {"users": [admin_user_row(u) for u in users], "next_cursor": next_cursor}
+
+@app.get("/api/admin/chat_metrics")
+async def admin_chat_metrics(admin: Principal = Depends(get_admin)):
+    """Websocket fan-out metrics: connections, queue depths, delivery latency, write-behind buffer."""
+    return {**manager.stats(), "writer": chat_writer.stats(), "principals": principals.stats(), "pages": page_cache.stats()}
+
+@app.get("/api/admin/db_metrics")
+async def admin_db_metrics(admin: Principal = Depends(get_admin)):
+    """Connection pool usage per engine (main DB sync/async and every opened match source)."""
+    return db.pool_stats()
+
 @app.post("/api/admin/update_subscription")
 async def admin_update_subscription(
     telegram_id: int = Form(...),
     action: str = Form(...),
     days: int = Form(30),
-    user_id: str = Cookie(None),
+    admin: Principal = Depends(get_admin),
     db_sess: Session = Depends(get_db)
 ):
-    if not user_id: raise HTTPException(status_code=403)
-    admin = db_sess.query(User).filter_by(telegram_id=int(user_id)).first()
-    if not admin or not admin.is_admin: raise HTTPException(status_code=403)
 
     target_user = db_sess.query(User).filter_by(telegram_id=telegram_id).first()
     if not target_user: raise HTTPException(status_code=404, detail="Пользователь не найден")
@@ -673,6 +1090,7 @@ async def admin_update_subscription(
         target_user.premium_since = None
         target_user.premium_until = None
     
+    invalidate_principals(db_sess, [telegram_id])
     db_sess.commit()
     return {"status": "success"}
 
@@ -681,12 +1099,9 @@ async def admin_toggle_ban(
     telegram_id: int = Form(...),
     is_banned: bool = Form(...),
     duration_days: int = Form(0),
-    user_id: str = Cookie(None),
+    admin: Principal = Depends(get_admin),
     db_sess: Session = Depends(get_db)
 ):
-    if not user_id: raise HTTPException(status_code=403)
-    admin = db_sess.query(User).filter_by(telegram_id=int(user_id)).first()
-    if not admin or not admin.is_admin: raise HTTPException(status_code=403)
 
     target_user = db_sess.query(User).filter_by(telegram_id=telegram_id).first()
     if not target_user: raise HTTPException(status_code=404, detail="Пользователь не найден")
@@ -702,18 +1117,16 @@ async def admin_toggle_ban(
     else:
         target_user.ban_until = None
 
+    invalidate_principals(db_sess, [telegram_id])
     db_sess.commit()
     return {"status": "success"}
 
 @app.post("/api/admin/delete_user")
 async def admin_delete_user(
     telegram_id: int = Form(...),
-    user_id: str = Cookie(None),
+    admin: Principal = Depends(get_admin),
     db_sess: Session = Depends(get_db)
 ):
-    if not user_id: raise HTTPException(status_code=403)
-    admin = db_sess.query(User).filter_by(telegram_id=int(user_id)).first()
-    if not admin or not admin.is_admin: raise HTTPException(status_code=403)
 
     target_user = db_sess.query(User).filter_by(telegram_id=telegram_id).first()
     if not target_user: raise HTTPException(status_code=404, detail="Пользователь не найден")
@@ -722,13 +1135,14 @@ async def admin_delete_user(
 
     db_sess.commit() # Ensure previous changes are saved
     db_sess.delete(target_user)
+    invalidate_principals(db_sess, [telegram_id])
     db_sess.commit()
     return {"status": "success"}
 
 # --- ANALYTICS ROUTES ---
 
 @app.get("/analytics", response_class=HTMLResponse)
-async def analytics_page(request: Request, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def analytics_page(request: Request, user: Principal = Depends(get_current_user)):
     if not user: return RedirectResponse("/")
     if user and user.is_banned:
         return templates.TemplateResponse("banned.html", {"request": request, "user_obj": user, "user": user}, status_code=403)
@@ -737,9 +1151,8 @@ async def analytics_page(request: Request, user: User = Depends(get_current_user
         # Simply redirect back to dashboard if not premium
         return RedirectResponse("/dashboard")
         
-    # Get all teams for the dropdown
-    teams_q = db.query(Match.team1).union(db.query(Match.team2)).distinct().all()
-    teams = sorted([t[0] for t in teams_q if t[0]])
+    # First teams for the dropdown, the search box queries /api/teams for the rest
+    teams = team_catalog.teams(limit=TEAM_LIST_LIMIT)
     
     return templates.TemplateResponse("analytics.html", {"request": request, "user": user, "teams": teams})
 
@@ -747,285 +1160,86 @@ async def analytics_page(request: Request, user: User = Depends(get_current_user
 async def predict_match(
     team1: str = Form(...),
     team2: str = Form(...)
-    # Using global 'db' for aggregation
 ):
-    # --- HELPER: STATS CALC ---
-    def calculate_stats(team_name, all_matches, lookback=20):
-        # Filter for this team
-        relevant = []
-        for m in all_matches:
-            if m.team1 == team_name or m.team2 == team_name:
-                relevant.append(m)
-        
-        # Sort by latest
-        # Note: We rely on list already being somewhat sorted or sort here
-        # Assuming matches returned by DB need sorting? get_team_matches does NOT sort by default potentially
-        # Let's sort manually to be safe
-        def sort_key(m):
-            try: return datetime.strptime(str(m.match_time), '%Y-%m-%d %H:%M')
-            except: return datetime.min
-            
-        relevant.sort(key=sort_key, reverse=True)
-        recent = relevant[:lookback]
-        
-        total = len(recent)
-        if total == 0:
-            return 0.5, 0.5, 0.5 # Default
-            
-        wins = 0
-        fb_count = 0
-        map1_wins = 0
-        
-        for m in recent:
-            # Winrate
-            s1, s2 = 0, 0
-            if m.score and ':' in m.score:
-                try: s1, s2 = map(int, m.score.split(':'))
-                except: pass
-                
-            winner = None
-            if s1 > s2: winner = m.team1
-            elif s2 > s1: winner = m.team2
-            
-            if winner == team_name: wins += 1
-            
-            # FB (First Blood)
-            # Check 'first_blood' field
-            if hasattr(m, 'first_blood') and m.first_blood == team_name:
-                fb_count += 1
-                
-            # Map 1 Win
-            # Need to parse history or map_scores? 
-            # If map_scores is "16:5", that's Map 1.
-            # If history has "map_1": "16:5"
-            map1_winner = None
-            
-            # Try History first
-            h = m.history if isinstance(m.history, dict) else {}
-            m1_score = h.get('map_1')
-            if not m1_score:
-                # Fallback to map_scores if single map match
-                if m.map_scores and isinstance(m.map_scores, str) and ':' in m.map_scores:
-                    m1_score = m.map_scores
-            
-            if m1_score and ':' in m1_score:
-                try: 
-                    mk1, mk2 = map(int, m1_score.split(':'))
-                    if mk1 > mk2: map1_winner = m.team1
-                    elif mk2 > mk1: map1_winner = m.team2
-                except: pass
-            
-            if map1_winner == team_name:
-                map1_wins += 1
-        
-        return (wins/total), (fb_count/total), (map1_wins/total)
-
-    # --- 1. FETCH AGGREGATED DATA ---
-    matches_t1 = db.get_team_matches(team1)
-    matches_t2 = db.get_team_matches(team2)
-    
-    # --- 2. CALCULATE METRICS ---
-    wr_t1, fb_t1, m1_t1 = calculate_stats(team1, matches_t1)
-    wr_t2, fb_t2, m1_t2 = calculate_stats(team2, matches_t2)
-    
-    # --- 3. H2H ---
-    # Intersect matches
-    h2h_wins_t1 = 0
-    h2h_total = 0
-    
-    # We can iterate one list and check if opponent is team2
-    for m in matches_t1:
-        if m.team1 == team2 or m.team2 == team2:
-            h2h_total += 1
-            # Determine winner
-            s1, s2 = 0, 0
-            if m.score and ':' in m.score:
-                try: s1, s2 = map(int, m.score.split(':'))
-                except: pass
-            if s1 > s2: 
-                if m.team1 == team1: h2h_wins_t1 += 1
-            elif s2 > s1:
-                if m.team2 == team1: h2h_wins_t1 += 1
-                
-    h2h_rate_t1 = h2h_wins_t1 / h2h_total if h2h_total > 0 else 0.5
-    
-    # --- 4. WEIGHTED FORMULA ---
-    # Formula: 
-    # Global Confidence for T1 = 
-    #   30% H2H 
-    # + 30% Recent Winrate Diff (normalized)
-    # + 20% FB Rate Diff
-    # + 20% Map 1 Rate Diff
-    
-    # Normalize Comparison: P(T1) = T1 / (T1 + T2)
-    
-    def normalize(v1, v2):
-        s = v1 + v2
-        return v1 / s if s > 0 else 0.5
-        
-    p_h2h = h2h_rate_t1 # Already T1 vs Total
-    p_wr  = normalize(wr_t1, wr_t2)
-    p_fb  = normalize(fb_t1, fb_t2)
-    p_m1  = normalize(m1_t1, m1_t2)
-    
-    # Adjust weights if no H2H
-    if h2h_total == 0:
-        # 40% WR, 30% FB, 30% M1
-        final_score = (p_wr * 0.4) + (p_fb * 0.3) + (p_m1 * 0.3)
-    else:
-        # 30% H2H, 30% WR, 20% FB, 20% M1
-        final_score = (p_h2h * 0.3) + (p_wr * 0.3) + (p_fb * 0.2) + (p_m1 * 0.2)
-        
-    # --- 5. RESULT ---
-    winner = team1 if final_score >= 0.5 else team2
-    confidence = int(final_score * 100) if winner == team1 else int((1 - final_score) * 100)
-    
-    # Cap
-    confidence = max(51, min(confidence, 92))
-    
-    # Display Stats
-    disp_fb = int(fb_t1 * 100) if winner == team1 else int(fb_t2 * 100)
-    
-    return {
-        "winner": winner,
-        "confidence": confidence,
-        "team1": team1,
-        "team2": team2,
-        "stats": {
-            "avg_duration": "~35-45m",
-            "first_blood_rate": disp_fb, 
-            "win_probability": confidence
-        }
-    }
-
-@app.get("/api/matches")
-async def get_matches_paginated(
-    skip: int = 0,
-    limit: int = 10
-    # No Depends(get_db) needed for aggregation since we use global 'db' which manages its own sessions
+    # Upcoming matches are precomputed by match_sync_loop, so every worker answers the same
+    stored = await db.run_sync(db.get_stored_prediction, team1, team2)
+    if stored: return stored.payload()
+    # Any other pair is scored from the in-memory columnar index, see predictor.PredictionEngine
+    return predictor.predict(team1, team2)
+
+class PredictPair(BaseModel):
+    team1: str
+    team2: str
+
+PREDICT_BATCH_LIMIT = getattr(config, "PREDICT_BATCH_LIMIT", 500)
+
+@app.post("/api/predict/batch")
+async def predict_batch(pairs: List[PredictPair]):
+    """Scores many pairs in one vectorized pass. Body: [{"team1": ..., "team2": ...}, ...]."""
+    if len(pairs) > PREDICT_BATCH_LIMIT:
+        raise HTTPException(status_code=413, detail=f"At most {PREDICT_BATCH_LIMIT} pairs per request")
+    return {"predictions": predictor.predict_many([(p.team1, p.team2) for p in pairs])}
+
+@app.get("/api/predictions")
+async def get_predictions(
+    game_type: str = Query(None),
+    limit: int = Query(100, ge=1, le=1000)
 ):
-    # Only FINISHED matches (Aggregated)
-    matches = db.get_finished_matches_paginated(skip=skip, limit=limit)
-    
-    result = []
-    for m in matches:
-        scores = m.score.split(':') if m.score and ':' in m.score else ["0", "0"]
-        try:
-            s1 = int(scores[0])
-            s2 = int(scores[1])
-        except:
-            s1, s2 = 0, 0
-            
-        result.append({
-            "id": m.id,
-            "match_time": m.match_time,
-            "league": m.game_type, # Using game_type based on user feedback
-            "team1": m.team1,
-            "team2": m.team2,
-            "score": m.score,
-            "s1": s1,
-            "s2": s2,
-            "odds_p1": m.odds_p1,
-            "odds_p2": m.odds_p2,
-            "map_scores": m.map_scores # Will be parsed by JS if possible, but usually string now
-        })
-        
-    return result
+    """Stored predictions of upcoming matches, soonest first."""
+    rows = await db.run_sync(db.get_predictions, game_type, limit)
+    return {"predictions": [p.payload() for p in rows]}
 
 @app.post("/api/team_stats")
 async def get_team_stats(
     team: str = Form(...)
 ):
-    from sqlalchemy import or_
-    import random
-
-    # Query all finished matches for the team using aggregation
-    matches = db.get_team_matches(team)
-
-    total_games = len(matches)
-    wins = 0
-    losses = 0
-    ranking_score = 1000 # Base ELO-like score (Mock start)
+    # Precomputed aggregates and rating (see Database.sync_team_matches / sync_ratings)
+    stats, last_5, rating = await asyncio.gather(
+        db.run_sync(db.get_team_stats, team),
+        db.run_sync(db.get_team_form, team, 5),
+        db.run_sync(db.get_team_rating, team)
+    )
+    total_games = stats.games if stats else 0
+    wins = stats.wins if stats else 0
+    losses = stats.losses if stats else 0
+    ranking_score = round(rating.rating) if rating else round(RatingEngine().initial)
 
-    # Calculate real Winrate
-    for m in matches:
-        # Determine winner from score "S1:S2"
-        if not m.score or ':' not in m.score: continue
-        try:
-            s1, s2 = map(int, m.score.split(':'))
-            winner_name = None
-            if s1 > s2: winner_name = m.team1
-            if s2 > s1: winner_name = m.team2
-            
-            if winner_name == team:
-                wins += 1
-            else:
-                losses += 1
-        except:
-            continue
-            
-    winrate = (wins / total_games * 100) if total_games > 0 else 0
-    
-    # Mock/derived stats since we don't have granular event data yet
-    fb_rate = int(winrate * 0.9) + random.randint(-5, 5) # Correlation with winrate
-    fb_rate = max(10, min(fb_rate, 90))
-    
-    map1_wr = int(winrate) + random.randint(-10, 10)
-    map1_wr = max(10, min(map1_wr, 90))
+    def percent(count):
+        return int(count / total_games * 100) if total_games > 0 else 0
 
     return {
         "team": team,
         "total_games": total_games,
         "wins": wins,
         "losses": losses,
-        "winrate": int(winrate),
-        "fb_rate": fb_rate,
-        "map1_winrate": map1_wr,
-        "last_5": [
-            1 if (m.team1 == team and int(m.score.split(':')[0]) > int(m.score.split(':')[1])) or 
-                 (m.team2 == team and int(m.score.split(':')[1]) > int(m.score.split(':')[0])) else 0 
-            for m in matches[-5:]
-        ] if total_games > 0 else []
+        "winrate": percent(wins),
+        "fb_rate": percent(stats.first_bloods if stats else 0),
+        "map1_winrate": percent(stats.map1_wins if stats else 0),
+        "ranking_score": ranking_score,
+        "last_5": last_5 if total_games > 0 else []
     }
 
 @app.get("/api/leagues")
-async def get_leagues(db: Session = Depends(get_db)):
-    # Get distinct leagues (game_type) from matches or stream channels? 
-    # User wants match analysis, so matches table.
-    # We should exclude 'Unknown' leagues if possible.
-    results = db.query(Match.game_type).distinct().all()
-    # Filter out empty or None
-    leagues = [r[0] for r in results if r[0]]
-    return {"leagues": sorted(leagues)}
+async def get_leagues():
+    # Leagues (game_type) of all match sources, from the in-memory catalog
+    return {"leagues": team_catalog.leagues()}
 
 @app.get("/api/teams")
 async def get_teams(
     league: str = Query(None),
-    db: Session = Depends(get_db)
+    q: str = Query(None),
+    limit: int = Query(TEAM_LIST_LIMIT, ge=1, le=1000)
 ):
-    from sqlalchemy import or_
-    
-    query = db.query(Match.team1).union(db.query(Match.team2))
-    
-    if league:
-        # Filter matches by game_type before union?
-        # Union is tricky with filters.
-        # Better:
-        # distinct team1 from matches where game_type=league
-        # UNION
-        # distinct team2 from matches where game_type=league
-        
-        q1 = db.query(Match.team1).filter(Match.game_type == league)
-        q2 = db.query(Match.team2).filter(Match.game_type == league)
-        query = q1.union(q2)
-        
-    results = query.distinct().all()
-    teams = sorted([r[0] for r in results if r[0]])
-    return {"teams": teams}
+    """Teams of a league (or all), `q` = prefix of the name or of any word in it."""
+    return {"teams": team_catalog.teams(league=league or None, prefix=q, limit=limit)}
 
 if __name__ == "__main__":
     print("\n" + "="*50)
     print(" >>> ATTENTION! SERVER IS STARTING <<< ")
     print(" >>> USE THIS URL: http://localhost:8090/streams <<<")
     print("="*50 + "\n")
-    uvicorn.run(app, host="0.0.0.0", port=8090)
+    workers = getattr(config, "WEB_WORKERS", 1)
+    if workers > 1 and not getattr(config, "CHAT_PUBSUB_URL", ""):
+        print(" >>> WARNING: WEB_WORKERS > 1 without CHAT_PUBSUB_URL, chat will be split per worker <<<")
+    # An import string is required for workers > 1
+    uvicorn.run("main:app", host="0.0.0.0", port=8090, workers=workers)
@@ -30,6 +30,11 @@ try:
         except Exception as e:
             print(f"Skipped premium_until: {e}")
 
+    # Admin user list indexes (no-op if they already exist)
+    for index in User.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    print("Indexes ready.")
+
     print("Migration Complete!")
 except Exception as e:
     print(f"Critical Error: {e}")
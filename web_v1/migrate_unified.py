@@ -1,36 +1,92 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, inspect, text
 import os
+import sys
 
-# DB Path
+import config
+from database import DEFAULT_MATCH_SOURCES, Match, backfill_match_ts, main_db_url
+
+# DB Paths (main web DB + bot DBs), used on Windows (local dev). Elsewhere the Main DB and the
+# match source DSNs from config are migrated. Pass file paths or DSNs as arguments to migrate others.
 current_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.dirname(current_dir)
-db_path = os.path.join(project_root, "berserk_local_v2.db")
-db_url = f"sqlite:///{db_path}"
-
-print(f"Connecting to: {db_url}")
-
-engine = create_engine(db_url)
-
-with engine.connect() as conn:
-    print("Checking 'matches' table...")
-    try:
-        # Check if column exists
-        result = conn.execute(text("PRAGMA table_info(matches)"))
-        columns = [row[1] for row in result.fetchall()]
-        
-        if 'game_type' not in columns:
-            print("Message: Adding 'game_type' column...")
-            conn.execute(text("ALTER TABLE matches ADD COLUMN game_type VARCHAR(50) DEFAULT 'CS2'"))
-            conn.commit()
-            print("Success: Column added.")
-            
-            # Update existing records to 'CS2'
-            print("Updating existing records to CS2...")
-            conn.execute(text("UPDATE matches SET game_type = 'CS2' WHERE game_type IS NULL"))
-            conn.commit()
-            print("Success: Records updated.")
-        else:
-            print("Info: 'game_type' column already exists.")
-            
-    except Exception as e:
-        print(f"Error: {e}")
+DB_FILES = {
+    "berserk_local_v2.db": "CS2",
+    "berserk_cs2_v2.db": "CS2",
+    "berserk_dota_v2.db": "DOTA2",
+}
+
+def migrate(db_url, default_game_type="CS2"):
+    if db_url.startswith("sqlite"):
+        # timeout = busy wait, bots may be writing to the same file while we migrate
+        engine = create_engine(db_url, connect_args={"timeout": 30})
+    else:
+        engine = create_engine(db_url, pool_pre_ping=True)
+    print(f"Connecting to: {engine.url.render_as_string(hide_password=True)}")
+
+    if not inspect(engine).has_table("matches"):
+        print("Info: no 'matches' table, skipping.")
+        return
+
+    with engine.connect() as conn:
+        print("Checking 'matches' table...")
+        try:
+            # Check if column exists (works for SQLite and MySQL)
+            columns = [c["name"] for c in inspect(conn).get_columns("matches")]
+
+            if 'game_type' not in columns:
+                print("Message: Adding 'game_type' column...")
+                conn.execute(text(f"ALTER TABLE matches ADD COLUMN game_type VARCHAR(50) DEFAULT '{default_game_type}'"))
+                conn.commit()
+                print("Success: Column added.")
+
+                # Update existing records
+                print(f"Updating existing records to {default_game_type}...")
+                conn.execute(text("UPDATE matches SET game_type = :gt WHERE game_type IS NULL"), {"gt": default_game_type})
+                conn.commit()
+                print("Success: Records updated.")
+            else:
+                print("Info: 'game_type' column already exists.")
+
+            if 'match_ts' not in columns:
+                print("Message: Adding 'match_ts' column...")
+                conn.execute(text("ALTER TABLE matches ADD COLUMN match_ts DATETIME"))
+                conn.commit()
+                print("Success: Column added.")
+            else:
+                print("Info: 'match_ts' column already exists.")
+
+        except Exception as e:
+            print(f"Error: {e}")
+            return
+
+    # Composite indexes for ORDER BY match_ts (no-op if they already exist)
+    for index in Match.__table__.indexes:
+        index.create(engine, checkfirst=True)
+    print("Success: Indexes ready.")
+
+    # Batched backfill, one short transaction per batch
+    print("Backfilling 'match_ts'...")
+    updated = backfill_match_ts(engine)
+    print(f"Success: {updated} rows backfilled.")
+
+def configured_urls():
+    """(url, default game_type) of the Main DB and of every match source with its own DSN."""
+    urls = {main_db_url(): "CS2"}
+    for entry in getattr(config, "MATCH_SOURCES", DEFAULT_MATCH_SOURCES):
+        if entry.get("dsn"): urls.setdefault(entry["dsn"], entry["game_type"])
+    return list(urls.items())
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        for target in sys.argv[1:]:
+            migrate(target if "://" in target else f"sqlite:///{os.path.abspath(target)}")
+    elif sys.platform == "win32":
+        for name, game_type in DB_FILES.items():
+            path = os.path.join(project_root, name)
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                print(f"Info: {name} is missing or empty, skipping.")
+                continue
+            migrate(f"sqlite:///{path}", game_type)
+    else:
+        for url, game_type in configured_urls():
+            migrate(url, game_type)
@@ -0,0 +1,89 @@
+import hashlib
+import time
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+
+from markupsafe import Markup
+
+def user_role(user) -> str:
+    """The flags cached templates branch on: "anon", "basic" or "admin", "premium", "admin+premium"."""
+    if not user: return "anon"
+    return "+".join(flag for flag in ("admin", "premium") if getattr(user, f"is_{flag}")) or "basic"
+
+def user_fingerprint(user) -> str:
+    """Short hash of the per-user parts of the page shell (avatar, premium dates, notifications)."""
+    if not user: return "anon"
+    state = repr(tuple(getattr(user, field) for field in user.FIELDS))
+    return hashlib.blake2b(state.encode(), digest_size=6).hexdigest()
+
+class Fragment:
+    """Rendered `content` block of a page with its validators."""
+    __slots__ = ("html", "etag", "last_modified")
+
+    def __init__(self, html: str):
+        self.html = Markup(html)
+        self.etag = hashlib.blake2b(html.encode(), digest_size=8).hexdigest()
+        self.last_modified = time.time()
+
+class Payload:
+    """Serialized API response body with its validators."""
+    __slots__ = ("body", "etag", "last_modified")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+        self.last_modified = time.time()
+
+class PageCache:
+    """LRU of rendered page fragments (and API payloads) keyed by (template, key, data versions, role).
+
+    Writes bump a named data version ("matches", "disciplines", "channels", "users"),
+    which changes the key of every fragment that depends on it. Old entries just age out.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.versions = {}
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def bump(self, *names):
+        for name in names:
+            self.versions[name] = self.versions.get(name, 0) + 1
+
+    def key(self, template_name, key, deps, role):
+        return (template_name, key, tuple(self.versions.get(name, 0) for name in deps), role)
+
+    def get(self, cache_key):
+        fragment = self.entries.get(cache_key)
+        if fragment is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(cache_key)
+        self.hits += 1
+        return fragment
+
+    def put(self, cache_key, fragment: Fragment):
+        self.entries[cache_key] = fragment
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "versions": dict(self.versions)}
+
+def not_modified(request, etag: str, last_modified: float) -> bool:
+    """Conditional GET check. If-None-Match wins over If-Modified-Since (RFC 9110)."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(",")]
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def http_date(ts: float) -> str:
+    return formatdate(ts, usegmt=True)
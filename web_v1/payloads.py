@@ -0,0 +1,42 @@
+import json
+from operator import itemgetter
+
+from fastapi.responses import Response
+
+try:
+    import orjson # Optional dependency, the stdlib encoder is used without it
+except ImportError:
+    orjson = None
+
+def dumps(obj) -> bytes:
+    """Compact JSON bytes (orjson if installed)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=lambda o: o.isoformat()).encode()
+
+class FastJSONResponse(Response):
+    """JSON response encoded by `dumps`, skipping FastAPI's jsonable_encoder walk.
+
+    Content may also be bytes that are already encoded (cached pages).
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return content if isinstance(content, bytes) else dumps(content)
+
+def compile_mapper(source_fields, fields):
+    """Builds a `row -> dict` function for tuples laid out as `source_fields`.
+
+    `fields` maps output keys to source field names. The positions are resolved once,
+    so mapping a row is one itemgetter call and a zip: no getattr or ORM state.
+    """
+    index = {name: i for i, name in enumerate(source_fields)}
+    keys = tuple(fields)
+    positions = [index[fields[key]] for key in keys]
+    if len(positions) == 1:
+        key, position = keys[0], positions[0]
+        return lambda row: {key: row[position]}
+    if not positions:
+        return lambda row: {}
+    values = itemgetter(*positions)
+    return lambda row: dict(zip(keys, values(row)))
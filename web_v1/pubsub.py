@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+# Channels shared by all web workers
+CHAT_CHANNEL = "chat:messages"
+PRESENCE_CHANNEL = "chat:presence"
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# --- IN-PROCESS BACKEND (single worker, default) ---
+
+class InProcessPubSub:
+    """Delivers published messages straight back to this process. Only valid with one worker."""
+
+    def __init__(self):
+        self.handler = None
+        self.presence = {}
+        self.version = 0
+
+    async def start(self, handler):
+        self.handler = handler
+
+    async def publish(self, channel: str, text: str):
+        if self.handler:
+            await self.handler(channel, text)
+
+    async def set_presence(self, users: dict):
+        """Replaces this worker's online users ({user_id: user_data})."""
+        self.presence = dict(users)
+
+    async def get_presence(self) -> dict:
+        """Online users of all workers."""
+        return dict(self.presence)
+
+    async def next_presence_version(self) -> int:
+        self.version += 1
+        return self.version
+
+    async def presence_version(self) -> int:
+        return self.version
+
+    async def close(self):
+        self.handler = None
+
+# --- REDIS BACKEND (N workers) ---
+
+class RedisPubSub:
+    """Redis (or any Redis-protocol server) pub/sub, so every worker sees every chat message.
+
+    Presence is stored per worker in a hash with a TTL refreshed by a heartbeat,
+    so a crashed worker's users expire instead of staying online forever.
+    """
+
+    PRESENCE_KEY = "chat:presence:{}"
+    VERSION_KEY = "chat:presence_version"
+
+    def __init__(self, url: str, worker_id: str = WORKER_ID, presence_ttl: int = 30):
+        import redis.asyncio as aioredis # Optional dependency, only needed for multi-worker setups
+        self.redis = aioredis.from_url(url)
+        self.worker_id = worker_id
+        self.presence_ttl = presence_ttl
+        self.local_users = {}
+        self.tasks = []
+
+    async def start(self, handler):
+        self.pubsub = self.redis.pubsub()
+        await self.pubsub.subscribe(CHAT_CHANNEL, PRESENCE_CHANNEL)
+        self.tasks = [
+            asyncio.create_task(self._read_loop(handler)),
+            asyncio.create_task(self._heartbeat()),
+        ]
+
+    async def _read_loop(self, handler):
+        while True:
+            try:
+                async for msg in self.pubsub.listen():
+                    if msg.get("type") != "message": continue
+                    channel = msg["channel"].decode() if isinstance(msg["channel"], bytes) else msg["channel"]
+                    data = msg["data"].decode() if isinstance(msg["data"], bytes) else msg["data"]
+                    try:
+                        await handler(channel, data)
+                    except Exception as e:
+                        logger.error(f"PubSub handler error: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"PubSub connection lost, resubscribing: {e}")
+                await asyncio.sleep(1)
+                try:
+                    await self.pubsub.subscribe(CHAT_CHANNEL, PRESENCE_CHANNEL)
+                except Exception:
+                    pass
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.presence_ttl / 3)
+            try:
+                await self._write_presence()
+            except Exception as e:
+                logger.error(f"Presence heartbeat failed: {e}")
+
+    async def _write_presence(self):
+        key = self.PRESENCE_KEY.format(self.worker_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        if self.local_users:
+            pipe.hset(key, mapping={str(uid): json.dumps(data) for uid, data in self.local_users.items()})
+            pipe.expire(key, self.presence_ttl)
+        await pipe.execute()
+
+    async def publish(self, channel: str, text: str):
+        await self.redis.publish(channel, text)
+
+    async def set_presence(self, users: dict):
+        self.local_users = dict(users)
+        await self._write_presence()
+
+    async def get_presence(self) -> dict:
+        users = {}
+        async for key in self.redis.scan_iter(match=self.PRESENCE_KEY.format("*")):
+            for uid, data in (await self.redis.hgetall(key)).items():
+                users[int(uid)] = json.loads(data)
+        return users
+
+    async def next_presence_version(self) -> int:
+        """Global counter, so presence deltas from all workers share one sequence."""
+        return await self.redis.incr(self.VERSION_KEY)
+
+    async def presence_version(self) -> int:
+        return int(await self.redis.get(self.VERSION_KEY) or 0)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        try:
+            await self.redis.delete(self.PRESENCE_KEY.format(self.worker_id))
+            await self.pubsub.close()
+            await self.redis.close()
+        except Exception:
+            pass
+
+def create_pubsub(url: str = None):
+    """Backend from config: empty URL = in-process, redis://... = shared between workers."""
+    if not url:
+        return InProcessPubSub()
+    return RedisPubSub(url)
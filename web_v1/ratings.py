@@ -0,0 +1,113 @@
+import math
+
+import config
+
+RATING_SYSTEM = getattr(config, "RATING_SYSTEM", "elo") # "elo" or "glicko"
+RATING_INITIAL = getattr(config, "RATING_INITIAL", 1500.0)
+RATING_K = getattr(config, "RATING_K", 32.0)
+RATING_INITIAL_RD = getattr(config, "RATING_INITIAL_RD", 350.0)
+RATING_MIN_RD = getattr(config, "RATING_MIN_RD", 30.0)
+RATING_RD_GROWTH = getattr(config, "RATING_RD_GROWTH", 35.0)
+
+Q = math.log(10) / 400
+
+def g(rd):
+    """Glicko attenuation of a rating difference by its uncertainty (1 for rd = 0, i.e. plain Elo)."""
+    return 1 / math.sqrt(1 + 3 * (Q * rd) ** 2 / math.pi ** 2)
+
+def expected_score(r1, r2, rd=0.0):
+    """Win probability of r1 against r2, `rd` = combined rating deviation of the pair."""
+    return 1 / (1 + 10 ** (-g(rd) * (r1 - r2) / 400))
+
+class RatingEngine:
+    """Elo or Glicko-1 ratings of the teams of one league, updated match by match.
+
+    State per team is [rating, rd, games, last_ts]. Updates depend only on the order of
+    the matches fed in, so replaying the same matches in time order always gives the
+    same ratings. With Glicko the RD of a team grows by `rd_growth` per idle day.
+    """
+
+    def __init__(self, system=RATING_SYSTEM, initial=RATING_INITIAL, k=RATING_K,
+                 initial_rd=RATING_INITIAL_RD, min_rd=RATING_MIN_RD, rd_growth=RATING_RD_GROWTH):
+        if system not in ("elo", "glicko"):
+            raise ValueError(f"Unknown rating system: {system}")
+        self.system = system
+        self.initial = float(initial)
+        self.k = float(k)
+        self.initial_rd = float(initial_rd) if system == "glicko" else 0.0
+        self.min_rd = float(min_rd)
+        self.rd_growth = float(rd_growth)
+        self.ratings = {} # team -> [rating, rd, games, last_ts]
+
+    def load(self, team, rating, rd, games, last_ts):
+        self.ratings[team] = [rating, rd, games, last_ts]
+
+    def get(self, team):
+        state = self.ratings.get(team)
+        if state is None:
+            state = self.ratings[team] = [self.initial, self.initial_rd, 0, None]
+        return state
+
+    def _rd_at(self, state, ts):
+        """RD of a team at time `ts`, grown by the time it has been idle."""
+        rd = state[1]
+        if self.system != "glicko" or not ts or not state[3]: return rd
+        days = max((ts - state[3]).total_seconds() / 86400, 0)
+        return min(math.sqrt(rd ** 2 + self.rd_growth ** 2 * days), self.initial_rd)
+
+    def _glicko(self, r, rd, r_opp, rd_opp, score):
+        """New (rating, rd) after one game, Glicko-1 with a rating period of one match."""
+        g_opp = g(rd_opp)
+        e = 1 / (1 + 10 ** (-g_opp * (r - r_opp) / 400))
+        d2 = 1 / (Q ** 2 * g_opp ** 2 * e * (1 - e))
+        denom = 1 / rd ** 2 + 1 / d2
+        return r + Q / denom * g_opp * (score - e), max(math.sqrt(1 / denom), self.min_rd)
+
+    def win_probability(self, team1, team2, ts=None):
+        a, b = self.get(team1), self.get(team2)
+        return expected_score(a[0], b[0], math.hypot(self._rd_at(a, ts), self._rd_at(b, ts)))
+
+    def apply(self, team1, team2, score, ts=None):
+        """Updates both teams with one result (score 1 = team1 won, 0 = team2 won).
+
+        Returns team1's win probability before the update.
+        """
+        a, b = self.get(team1), self.get(team2)
+        if self.system == "elo":
+            e = expected_score(a[0], b[0])
+            delta = self.k * (score - e)
+            a[0] += delta
+            b[0] -= delta
+        else:
+            rd_a, rd_b = self._rd_at(a, ts), self._rd_at(b, ts)
+            e = expected_score(a[0], b[0], math.hypot(rd_a, rd_b))
+            a[0], a[1], b[0], b[1] = (
+                *self._glicko(a[0], rd_a, b[0], rd_b, score),
+                *self._glicko(b[0], rd_b, a[0], rd_a, 1 - score)
+            )
+        for state in (a, b):
+            state[2] += 1
+            if ts: state[3] = ts
+        return e
+
+    def replay(self, matches):
+        """Feeds (team1, team2, score, ts) results in order. Returns fit metrics of the run.
+
+        Every match is predicted before it is applied, so log_loss and accuracy measure
+        how well the parameters forecast the next result (use them to tune k / rd_growth).
+        """
+        n = 0
+        log_loss = 0.0
+        correct = 0
+        for team1, team2, score, ts in matches:
+            e = self.apply(team1, team2, score, ts)
+            p = min(max(e if score else 1 - e, 1e-9), 1.0)
+            log_loss -= math.log(p)
+            correct += (e >= 0.5) == bool(score)
+            n += 1
+        return {
+            "matches": n,
+            "teams": len(self.ratings),
+            "log_loss": round(log_loss / n, 4) if n else None,
+            "accuracy": round(correct / n, 4) if n else None,
+        }
@@ -0,0 +1,27 @@
+import sys
+
+from database import Database
+
+# Full replay of the team ratings (team_ratings) from the team_matches index.
+# Normally they are kept up to date by the web app's background sync;
+# run this after changing the RATING_* settings.
+#
+# Try parameters without writing anything, e.g.:
+#   python rebuild_ratings.py --dry-run k=24
+#   python rebuild_ratings.py --dry-run system=glicko rd_growth=20
+dry_run = "--dry-run" in sys.argv
+params = {}
+for arg in sys.argv[1:]:
+    if "=" not in arg: continue
+    name, value = arg.split("=", 1)
+    params[name] = value if name == "system" else float(value)
+
+print("Replaying ratings..." + (" (dry run)" if dry_run else ""))
+db = Database()
+
+try:
+    for game_type, metrics in db.rebuild_ratings(store=not dry_run, **params).items():
+        print(f"{game_type}: {metrics}")
+    print("Done!")
+except Exception as e:
+    print(f"Error: {e}")
@@ -0,0 +1,13 @@
+from database import Database
+
+# Full recompute of the derived team tables (team_matches + team_stats).
+# Normally they are kept up to date by the web app's background sync;
+# run this after changing how stats are computed or if they drift.
+print("Rebuilding team stats...")
+db = Database()
+
+try:
+    added = db.rebuild_team_stats()
+    print(f"Done! Indexed {len(added)} team rows.")
+except Exception as e:
+    print(f"Error: {e}")